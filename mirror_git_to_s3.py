@@ -1,17 +1,34 @@
+import asyncio
+import heapq
 import itertools
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import posixpath
+import random
 import re
+import signal
+import tempfile
+import time
 import zlib
 import uuid
 import urllib.parse
-from collections import defaultdict, deque
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 from functools import partial
-from hashlib import sha1
-from queue import SimpleQueue, Queue
-from struct import unpack
-from threading import Lock, Event, Thread
+from hashlib import sha1, sha256
+from queue import Empty, SimpleQueue, Queue
+from struct import pack, unpack
+from contextlib import contextmanager, nullcontext
+from fnmatch import fnmatchcase
+from threading import BoundedSemaphore, Condition, Lock, Event, Thread, Timer, current_thread, local
 
 import boto3
+import botocore.exceptions
 import click
 import httpx
 from tqdm import tqdm
@@ -20,58 +37,1389 @@ from tqdm import tqdm
 logger = logging.getLogger(__name__)
 
 
+class RangesNotSupported(Exception):
+    pass
+
+
+def to_filelike_obj(iterable):
+    chunk = b''
+    offset = 0
+    it = iter(iterable)
+
+    def up_to_iter(num):
+        nonlocal chunk, offset
+
+        while num:
+            if offset == len(chunk):
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    break
+                else:
+                    offset = 0
+            to_yield = min(num, len(chunk) - offset)
+            offset = offset + to_yield
+            num -= to_yield
+            yield chunk[offset - to_yield:offset]
+
+    class FileLikeObj:
+        def read(self, n=-1):
+            n = \
+                n if n != -1 else \
+                float('infinity')
+            return b''.join(up_to_iter(n))
+
+    return FileLikeObj()
+
+
+def next_or_truncated_error(it):
+    try:
+        return next(it)
+    except StopIteration:
+        raise Exception('Truncated') from None
+
+
+def get_reader(bytes_iter, on_consumed=None):
+    # Chunks are wrapped in memoryviews so reads slice them without copying, and single bytes,
+    # which are most reads when parsing headers, are read without creating a generator
+    chunk = memoryview(b'')
+    offset = 0
+    it = iter(bytes_iter)
+
+    # Bytes are passed to on_consumed lazily, so any returned as unused are not included
+    reported_offset = 0
+    reported_total = 0
+
+    def _report():
+        nonlocal reported_offset, reported_total
+        if on_consumed is not None and offset != reported_offset:
+            on_consumed(chunk[reported_offset:offset])
+        reported_total += offset - reported_offset
+        reported_offset = offset
+
+    def _next_chunk():
+        nonlocal chunk, offset, reported_offset
+        _report()
+        chunk = memoryview(next_or_truncated_error(it))
+        offset = 0
+        reported_offset = 0
+
+    def _read(num_bytes):
+        nonlocal offset
+
+        while num_bytes:
+            if offset == len(chunk):
+                _next_chunk()
+            to_yield = min(num_bytes, len(chunk) - offset)
+            offset = offset + to_yield
+            num_bytes -= to_yield
+            yield chunk[offset - to_yield:offset]
+
+    def yield_indefinite(num_bytes=float('infinity')):
+        yield from _read(num_bytes)
+
+    def read_bytes(num_bytes):
+        nonlocal offset
+        if len(chunk) - offset >= num_bytes:
+            offset += num_bytes
+            return chunk[offset - num_bytes:offset].tobytes()
+        return b''.join(_read(num_bytes))
+
+    def read_byte():
+        nonlocal offset
+        while offset == len(chunk):
+            _next_chunk()
+        offset += 1
+        return chunk[offset - 1]
+
+    def return_unused(num_unused):
+        nonlocal offset
+        offset -= num_unused
+
+    def get_offset():
+        _report()
+        return reported_total
+
+    return yield_indefinite, read_bytes, read_byte, return_unused, get_offset
+
+
+def get_object_type_and_length(read_byte):
+    b = read_byte()
+
+    t = (b >> 4) & 7
+    length = (b & 15)
+    bits_to_shift_length = 4
+
+    while b & 128:
+        b = read_byte()
+        length += (b & 127) << bits_to_shift_length
+        bits_to_shift_length += 7
+
+    return t, length
+
+
+def get_length(read_byte):
+    bits_to_shift_length = 0
+    b = 128  # To enter the loop
+    length = 0
+
+    while b & 128:
+        b = read_byte()
+        length += (b & 127) << bits_to_shift_length
+        bits_to_shift_length += 7
+
+    return length
+
+
+def get_negative_offset(read_byte):
+    # The offset of the base of an OBJ_OFS_DELTA, which unlike other lengths is big-endian,
+    # with 1 added to all but the last byte so there is only one encoding of each value
+    b = read_byte()
+    offset = b & 127
+
+    while b & 128:
+        b = read_byte()
+        offset = ((offset + 1) << 7) + (b & 127)
+
+    return offset
+
+
+types_names_for_hash = {
+    1: b'commit',
+    2: b'tree',
+    3: b'blob',
+    4: b'tag',
+}
+types_for_name = {
+    name: object_type
+    for object_type, name in types_names_for_hash.items()
+}
+pack_types_names = {
+    **{object_type: name.decode() for object_type, name in types_names_for_hash.items()},
+    6: 'ofs-delta',
+    7: 'ref-delta',
+}
+
+
+def get_delta_instructions(delta_bytes, max_copy_size=None):
+    # The sizes of a delta's base and target, and its instructions. Delta payloads are small,
+    # so all of the instructions are decoded up front, which also frees the parser before
+    # waiting for the base. Explicit bytes are kept as the chunks they arrived in, and copies
+    # are split so none is larger than max_copy_size
+    yield_indefinite, _, read_byte, _, _ = get_reader(delta_bytes)
+    base_size = get_length(read_byte)
+    target_size = get_length(read_byte)
+
+    def read_sparse(instruction, instruction_bit_range):
+        value = 0
+        factor = 0
+        for b in instruction_bit_range:
+            has = (instruction >> b) & 1
+            if has:
+                value += read_byte() << factor
+            factor += 8
+        return value
+
+    instructions = []
+    target_size_remaining = target_size
+    while target_size_remaining > 0:
+        instruction = read_byte()
+        if instruction == 0:
+            raise ValueError('delta has a zero instruction')
+
+        # Explict bytes in the instruction
+        if not (instruction >> 7):
+            size = instruction & 127
+            target_size_remaining -= size
+            instructions.append((None, size, tuple(yield_indefinite(size))))
+            continue
+
+        offset = read_sparse(instruction, range(0, 4))
+        size = read_sparse(instruction, range(4, 7)) or 65536
+        target_size_remaining -= size
+        for piece_offset in range(offset, offset + size, max_copy_size or size):
+            instructions.append((piece_offset, min(max_copy_size or size, offset + size - piece_offset), None))
+
+    if target_size_remaining:
+        raise ValueError('delta has the wrong length')
+
+    # Not expecting any bytes - this is to exhaust the iterator to put back bytes after zlib
+    for _ in delta_bytes:
+        pass
+
+    return base_size, target_size, instructions
+
+
+def yield_delta_target(base_object, instructions):
+    # The bytes of a delta's target from its base in memory. Copies are sliced from a memoryview,
+    # so they aren't copied until they're used
+    base_object = memoryview(base_object)
+    for offset, size, chunks in instructions:
+        if offset is None:
+            yield from chunks
+        elif offset + size > len(base_object):
+            raise ValueError('delta copies from beyond its base')
+        else:
+            yield base_object[offset:offset + size]
+
+
+def get_lru_cache(max_size, get_size=len, on_get=lambda is_hit: None):
+    # Thread-safe LRU cache bounded by the total size of its values. Returns functions to get and
+    # put values, and to get the number of hits and misses so far
+    lock = Lock()
+    cache = OrderedDict()
+    size = 0
+    hits = 0
+    misses = 0
+
+    def get(key):
+        nonlocal hits, misses
+        with lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                hits += 1
+            else:
+                misses += 1
+        on_get(value is not None)
+        return value
+
+    def put(key, value):
+        nonlocal size
+        value_size = get_size(value)
+        if value_size > max_size:
+            return
+        with lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return
+            cache[key] = value
+            size += value_size
+            while size > max_size:
+                _, evicted = cache.popitem(last=False)
+                size -= get_size(evicted)
+
+    def get_stats():
+        with lock:
+            return hits, misses
+
+    return get, put, get_stats
+
+
+def yield_pkt_lines(bytes_iter):
+    # The payload of each pkt-line, and None for each flush, delimiter or response end packet.
+    # Responses end with a flush, so it's up to the caller to stop
+    _, read_bytes, _, _, _ = get_reader(bytes_iter)
+    while True:
+        length = int(read_bytes(4), 16)
+        yield read_bytes(length - 4) if length > 3 else None
+
+
+def demultiplex_pack(bytes_iter):
+    # In protocol v2, the pack is in the packfile section of the response, with its bytes in
+    # pkt-lines on band 1, interleaved with progress messages on band 2 and errors on band 3
+    lines = yield_pkt_lines(bytes_iter)
+    for line in lines:
+        if line == b'packfile\n':
+            break
+    for line in lines:
+        if line is None:
+            break
+        if line[0] == 1:
+            yield line[1:]
+        elif line[0] == 2:
+            logger.debug('Progress from server: %s', line[1:].decode(errors='replace').strip())
+        elif line[0] == 3:
+            raise Exception('Error from server: ' + line[1:].decode(errors='replace').strip())
+
+
+def parse_lfs_pointer(pointer_bytes):
+    # The SHA-256 and size of the LFS object, or None if the bytes are not an LFS pointer
+    if not pointer_bytes.startswith(b'version https://git-lfs.github.com/spec/v1\n'):
+        return None
+    lfs_sha256 = None
+    lfs_size = None
+    for line in pointer_bytes.splitlines():
+        key, value = line.split(b' ')
+        if key == b'oid':
+            lfs_sha256 = line.split(b':')[1].decode()
+        if key == b'size':
+            lfs_size = int(value.decode())
+    return lfs_sha256, lfs_size
+
+
+def hash_and_compress_objects(objects):
+    # Run in a separate process, so the CPU-bound work of small objects isn't limited to the
+    # single core that the threads of the main process share. For each object type name, object
+    # bytes and whether to compress, returns the SHA, the bytes of the loose object if compressed,
+    # and the LFS pointer if it is one
+    results = []
+    for type_name, object_bytes, should_compress in objects:
+        prefixed = type_name + b' ' + str(len(object_bytes)).encode() + b'\x00' + object_bytes
+        results.append((
+            sha1(prefixed).digest(),
+            zlib.compress(prefixed) if should_compress else None,
+            parse_lfs_pointer(object_bytes),
+        ))
+    return results
+
+
+def completed_future(func, *args):
+    # A Future of the result of calling func now, for storages that have nothing to gain from
+    # making requests asynchronously
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def after_all(futures, func):
+    # A Future of the result of calling func once all of the futures are done, or of the
+    # exception of the first of them that failed. func is called in the thread that completes
+    # the last future
+    result = Future()
+    remaining = len(futures)
+    lock = Lock()
+
+    def on_done(_):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            if remaining > 0:
+                return
+        exceptions = [future.exception() for future in futures if future.exception() is not None]
+        if exceptions:
+            result.set_exception(exceptions[0])
+            return
+        try:
+            result.set_result(func())
+        except Exception as e:
+            result.set_exception(e)
+
+    if not futures:
+        remaining = 1
+        on_done(None)
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
+
+
+def is_throttling_error(e):
+    # S3 responds with 503 SlowDown when a prefix gets more requests than it can handle, and other
+    # S3-compatible services can respond with 429 or 503
+    if isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get('Error', {}).get('Code') in ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', '503') \
+            or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in (429, 503)
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (429, 503)
+    return False
+
+
+def get_sorted_sha_position(sorted_shas, sha):
+    # A binary search of concatenated 20 byte SHAs, which takes far less memory than a set. None
+    # if the SHA isn't there
+    low = 0
+    high = len(sorted_shas) // 20
+    while low < high:
+        mid = (low + high) // 2
+        mid_sha = sorted_shas[mid * 20:mid * 20 + 20]
+        if mid_sha == sha:
+            return mid
+        if mid_sha < sha:
+            low = mid + 1
+        else:
+            high = mid
+    return None
+
+
+def sorted_shas_contain(sorted_shas, sha):
+    return get_sorted_sha_position(sorted_shas, sha) is not None
+
+
+class ShaIndex:
+    # SHAs in the order they're added, concatenated in a bytearray, with an open addressing hash
+    # table of their positions that's kept between a quarter and a half full. This takes 28 to 36
+    # bytes per SHA, where a set of bytes objects takes about 100. Not thread safe
+
+    def __init__(self):
+        self._shas = bytearray()
+        self._table = array('I', bytes(64))
+        self._mask = 15
+
+    def __len__(self):
+        return len(self._shas) // 20
+
+    def _find_slot(self, sha):
+        # SHAs are uniformly distributed, so their first bytes are as good as any hash
+        shas = self._shas
+        table = self._table
+        slot = int.from_bytes(sha[:8], 'little') & self._mask
+        while position_plus_one := table[slot]:
+            if shas[position_plus_one * 20 - 20:position_plus_one * 20] == sha:
+                break
+            slot = (slot + 1) & self._mask
+        return slot
+
+    def add(self, sha):
+        # Returns the position of the SHA, which is new if it wasn't already added
+        slot = self._find_slot(sha)
+        if self._table[slot]:
+            return self._table[slot] - 1
+        self._shas += sha
+        self._table[slot] = len(self)
+        if len(self) * 2 > len(self._table):
+            self._table = array('I', bytes(len(self._table) * 8))
+            self._mask = len(self._table) - 1
+            for position in range(0, len(self)):
+                self._table[self._find_slot(self._shas[position * 20:position * 20 + 20])] = position + 1
+        return len(self) - 1
+
+    def get_position(self, sha):
+        position_plus_one = self._table[self._find_slot(sha)]
+        return position_plus_one - 1 if position_plus_one else None
+
+    def get_sha(self, position):
+        return bytes(self._shas[position * 20:position * 20 + 20])
+
+    def __contains__(self, sha):
+        return self._table[self._find_slot(sha)] != 0
+
+    def __iter__(self):
+        return (self.get_sha(position) for position in range(0, len(self)))
+
+
+class ObjectRegistry:
+    # The offset in the pack of each object in the order they're parsed, and the SHA and type of
+    # each object once it's been uploaded, including objects from previous runs that deltas are
+    # against. Offsets are looked up by binary search since they're parsed in increasing order.
+    # With the ShaIndex, this takes about 41 to 49 bytes per object, rather than the 250 or so
+    # of dicts keyed by offset and by SHA. Not thread safe
+
+    def __init__(self):
+        self._offsets = array('Q')
+        self._positions_plus_one = array('I')
+        self._shas = ShaIndex()
+        self._types = bytearray()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def add_offset(self, pack_offset):
+        self._offsets.append(pack_offset)
+        self._positions_plus_one.append(0)
+
+    def _find_offset(self, pack_offset):
+        i = bisect_left(self._offsets, pack_offset)
+        return i if i < len(self._offsets) and self._offsets[i] == pack_offset else None
+
+    def complete(self, pack_offset, sha, object_type):
+        position = self._shas.add(sha)
+        if position == len(self._types):
+            self._types.append(object_type)
+        if pack_offset is not None:
+            self._positions_plus_one[self._find_offset(pack_offset)] = position + 1
+
+    def get_sha_at_offset(self, pack_offset):
+        # None if there's no object at the offset, or it's not yet uploaded
+        i = self._find_offset(pack_offset)
+        return self._shas.get_sha(self._positions_plus_one[i] - 1) if i is not None and self._positions_plus_one[i] else None
+
+    def get_next_offset(self, pack_offset):
+        # None if the object at the offset is the last, or there's no object at the offset
+        i = self._find_offset(pack_offset)
+        return self._offsets[i + 1] if i is not None and i + 1 < len(self._offsets) else None
+
+    def get_offset(self, sha):
+        # None if the object is not in the pack. This scans the offsets, so is only for the rare
+        # OBJ_REF_DELTA in a pack that's not thin
+        position = self._shas.get_position(sha)
+        try:
+            return self._offsets[self._positions_plus_one.index(position + 1)] if position is not None else None
+        except ValueError:
+            return None
+
+    def get_type(self, sha):
+        position = self._shas.get_position(sha)
+        return self._types[position] if position is not None else None
+
+    def __contains__(self, sha):
+        return sha in self._shas
+
+    def yield_shas_and_offsets(self):
+        # Of the objects in the pack, which must all have been uploaded
+        for pack_offset, position_plus_one in zip(self._offsets, self._positions_plus_one):
+            yield self._shas.get_sha(position_plus_one - 1), pack_offset
+
+
+class S3Storage:
+    # Keys are relative to the bucket. Missing keys raise KeyError
+
+    def __init__(self, s3_client, bucket, storage_class='STANDARD'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.storage_class = storage_class
+
+    def put(self, key, body):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, StorageClass=self.storage_class)
+
+    def put_async(self, key, body):
+        # Returns a Future that's done once the body is stored
+        return completed_future(self.put, key, body)
+
+    def put_stream(self, key, chunks):
+        self.s3_client.upload_fileobj(to_filelike_obj(chunks), Bucket=self.bucket, Key=key, ExtraArgs={'StorageClass': self.storage_class})
+
+    @contextmanager
+    def put_parts(self, key):
+        # Yields a function to put each part, numbered from 1, which can be called concurrently.
+        # All parts but the last must be at least 5MiB. If there's an exception, nothing is stored
+        upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=key, StorageClass=self.storage_class)['UploadId']
+        etags = {}
+
+        def put_part(part_number, body):
+            etags[part_number] = self.s3_client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body)['ETag']
+
+        try:
+            yield put_part
+        except BaseException:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': [
+            {'PartNumber': part_number, 'ETag': etag}
+            for part_number, etag in sorted(etags.items())
+        ]})
+
+    def get_stream(self, key, start=None, end=None):
+        range_kwargs = \
+            {} if start is None and end is None else \
+            {'Range': 'bytes={}-{}'.format(start or 0, end - 1)} if end is not None else \
+            {'Range': 'bytes={}-'.format(start)}
+        try:
+            resp = self.s3_client.get_object(Bucket=self.bucket, Key=key, **range_kwargs)
+        except self.s3_client.exceptions.NoSuchKey:
+            raise KeyError(key) from None
+        return resp['Body'].iter_chunks(65536)
+
+    def get(self, key, start=None, end=None):
+        return b''.join(self.get_stream(key, start, end))
+
+    def copy(self, source_key, key, size_hint=None):
+        # A single CopyObject is limited to 5GB, and over that the managed copy is needed, but it
+        # makes an extra HEAD request to find the size
+        if size_hint is not None and size_hint < 4294967296:
+            self.s3_client.copy_object(CopySource={
+                'Bucket': self.bucket,
+                'Key': source_key,
+            }, Bucket=self.bucket, Key=key, StorageClass=self.storage_class)
+        else:
+            self.s3_client.copy(CopySource={
+                'Bucket': self.bucket,
+                'Key': source_key,
+            }, Bucket=self.bucket, Key=key, ExtraArgs={'StorageClass': self.storage_class})
+
+    def delete(self, keys):
+        keys = iter(keys)
+        while batch := list(itertools.islice(keys, 1000)):
+            self.s3_client.delete_objects(Bucket=self.bucket, Delete={'Objects': [
+                {'Key': key}
+                for key in batch
+            ]})
+
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != '404':
+                raise
+            return False
+        return True
+
+    def list(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key']
+
+
+class AsyncS3Storage(S3Storage):
+    # Small PUTs and GETs are made from a single thread running an event loop, so hundreds can be
+    # in flight without a thread or a boto3 connection for each. They're signed by the boto3
+    # client as presigned URLs, which makes no requests, and sent by an httpx.AsyncClient.
+    # Everything else, including streamed and multipart uploads, is as in S3Storage. Call close
+    # once finished with it. Each request also holds shared_requests_in_flight if it's given, so
+    # a limit on the requests of the boto3 client can apply to these too
+
+    def __init__(self, s3_client, bucket, storage_class='STANDARD', max_requests_in_flight=1000, shared_requests_in_flight=None):
+        super().__init__(s3_client, bucket, storage_class)
+        self._requests_in_flight = BoundedSemaphore(max_requests_in_flight)
+        self._shared_requests_in_flight = shared_requests_in_flight
+        # The work an httpx connection pool does as each request finishes grows with the number
+        # of connections in it, so requests are spread over many small pools
+        num_clients = (max_requests_in_flight + 3) // 4
+        self._http_clients = [
+            httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(retries=3),
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+                timeout=60.0,
+            )
+            for _ in range(0, num_clients)
+        ]
+        self._next_http_client = itertools.cycle(self._http_clients)
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        for http_client in self._http_clients:
+            asyncio.run_coroutine_threadsafe(http_client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _request(self, client_method, method, key, params={}, headers={}, content=None):
+        # A Future of the response. If max_requests_in_flight are already in flight this blocks
+        # until one has finished, which also limits the memory taken by bodies waiting to be sent
+        url = self.s3_client.generate_presigned_url(client_method, Params={'Bucket': self.bucket, 'Key': key, **params})
+        http_client = next(self._next_http_client)
+
+        async def request():
+            response = await http_client.request(method, url, headers=headers, content=content)
+            if response.status_code == 404:
+                raise KeyError(key)
+            response.raise_for_status()
+            return response
+
+        def release(_):
+            if self._shared_requests_in_flight is not None:
+                self._shared_requests_in_flight.release()
+            self._requests_in_flight.release()
+
+        self._requests_in_flight.acquire()
+        if self._shared_requests_in_flight is not None:
+            self._shared_requests_in_flight.acquire()
+        future = asyncio.run_coroutine_threadsafe(request(), self._loop)
+        future.add_done_callback(release)
+        return future
+
+    def put(self, key, body):
+        self.put_async(key, body).result()
+
+    def put_async(self, key, body):
+        # The storage class is signed as a header rather than a query string parameter, other
+        # than in SigV2, so the request must send it as one
+        return after_all([self._request('put_object', 'PUT', key, params={'StorageClass': self.storage_class}, headers={'x-amz-storage-class': self.storage_class}, content=bytes(body))], lambda: None)
+
+    def get(self, key, start=None, end=None):
+        headers = \
+            {} if start is None and end is None else \
+            {'Range': 'bytes={}-{}'.format(start or 0, end - 1)} if end is not None else \
+            {'Range': 'bytes={}-'.format(start)}
+        return self._request('get_object', 'GET', key, headers=headers).result().content
+
+    def exists(self, key):
+        try:
+            self._request('head_object', 'HEAD', key).result()
+        except KeyError:
+            return False
+        return True
+
+
+class FilesystemStorage:
+    # Keys are paths relative to the root directory. Each file is written to a temporary file in
+    # the same directory and renamed into place, so readers never see a partial file
+
+    temp_prefix = '.mirror-git-to-s3-tmp-'
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, body):
+        self.put_stream(key, (body,))
+
+    def put_async(self, key, body):
+        return completed_future(self.put, key, body)
+
+    def put_stream(self, key, chunks):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=self.temp_prefix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @contextmanager
+    def put_parts(self, key):
+        # Each part is written to its own temporary file, and they're joined at the end
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_paths = {}
+
+        def put_part(part_number, body):
+            fd, part_paths[part_number] = tempfile.mkstemp(dir=os.path.dirname(path), prefix=self.temp_prefix)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+
+        def yield_parts():
+            for _, part_path in sorted(part_paths.items()):
+                with open(part_path, 'rb') as f:
+                    while chunk := f.read(65536):
+                        yield chunk
+
+        try:
+            yield put_part
+            self.put_stream(key, yield_parts())
+        finally:
+            for part_path in part_paths.values():
+                os.unlink(part_path)
+
+    def get_stream(self, key, start=None, end=None):
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+        def _get_stream():
+            with f:
+                f.seek(start or 0)
+                remaining = float('infinity') if end is None else end - (start or 0)
+                while remaining and (chunk := f.read(min(65536, remaining))):
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return _get_stream()
+
+    def get(self, key, start=None, end=None):
+        # Ranged reads of delta bases are frequent, and mmap avoids reading more than is needed
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key) from None
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[start:end]
+
+    def copy(self, source_key, key, size_hint=None):
+        self.put_stream(key, self.get_stream(source_key))
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def list(self, prefix):
+        # The prefix need not end at a directory boundary
+        prefix_dir = os.path.dirname(prefix)
+        for dirpath, dirnames, filenames in os.walk(self._path(prefix_dir)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if key.startswith(prefix) and not filename.startswith(self.temp_prefix):
+                    yield key
+
+
+class MemoryStorage:
+    # Useful to measure the speed of everything other than storage, and in tests
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = Lock()
+
+    def put(self, key, body):
+        with self._lock:
+            self.objects[key] = bytes(body)
+
+    def put_async(self, key, body):
+        return completed_future(self.put, key, body)
+
+    def put_stream(self, key, chunks):
+        self.put(key, b''.join(chunks))
+
+    @contextmanager
+    def put_parts(self, key):
+        parts = {}
+
+        def put_part(part_number, body):
+            parts[part_number] = bytes(body)
+
+        yield put_part
+        self.put(key, b''.join(part for _, part in sorted(parts.items())))
+
+    def get_stream(self, key, start=None, end=None):
+        return iter((self.get(key, start, end),))
+
+    def get(self, key, start=None, end=None):
+        with self._lock:
+            return self.objects[key][start:end]
+
+    def copy(self, source_key, key, size_hint=None):
+        self.put(key, self.get(source_key))
+
+    def delete(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self.objects.pop(key, None)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self.objects
+
+    def list(self, prefix):
+        with self._lock:
+            keys = sorted(self.objects.keys())
+        for key in keys:
+            if key.startswith(prefix):
+                yield key
+
+
+class Metrics:
+    # Counters, gauges and histograms, each identified by a name and a dict of labels. Gauges
+    # also keep the maximum they have been set to, since the final value of a queue depth says
+    # little about a run. Any object with the same inc, set and observe methods can be passed to
+    # mirror_repos instead, for example to forward to another metrics library
+
+    prefix = 'mirror_git_to_s3_'
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = Lock()
+
+    def inc(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            _, maximum = self.gauges.get(key, (value, value))
+            self.gauges[key] = (value, max(value, maximum))
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            bucket_counts, total, count = self.histograms.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    bucket_counts[i] += 1
+                    break
+            self.histograms[key] = (bucket_counts, total + value, count + 1)
+
+    def _get_cumulative_buckets(self, bucket_counts, count):
+        # Each bucket counts the observations less than or equal to its bound, and the +Inf
+        # bucket counts all of them, including any above the largest bound
+        return zip(self.buckets + ('+Inf',), itertools.accumulate(bucket_counts + [count - sum(bucket_counts)]))
+
+    def to_prometheus(self):
+        def format_labels(labels):
+            return '{' + ','.join(
+                name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                for name, value in labels
+            ) + '}' if labels else ''
+
+        def format_metrics(metric_type, items):
+            previous_name = None
+            for (name, labels), lines in sorted(items):
+                if name != previous_name:
+                    yield f'# TYPE {self.prefix}{name} {metric_type}\n'
+                    previous_name = name
+                for suffix, extra_labels, value in lines:
+                    yield f'{self.prefix}{name}{suffix}{format_labels(labels + extra_labels)} {value}\n'
+
+        with self._lock:
+            counters = [
+                (key, (('', (), value),))
+                for key, value in self.counters.items()
+            ]
+            gauges = [
+                (key, (('', (), value),))
+                for key, (value, maximum) in self.gauges.items()
+            ] + [
+                ((name + '_max', labels), (('', (), maximum),))
+                for (name, labels), (value, maximum) in self.gauges.items()
+            ]
+            histograms = [
+                (key, tuple(
+                    ('_bucket', (('le', bucket),), cumulative_count)
+                    for bucket, cumulative_count in self._get_cumulative_buckets(bucket_counts, count)
+                ) + (
+                    ('_sum', (), total),
+                    ('_count', (), count),
+                ))
+                for key, (bucket_counts, total, count) in self.histograms.items()
+            ]
+
+        return ''.join(itertools.chain(
+            format_metrics('counter', counters),
+            format_metrics('gauge', gauges),
+            format_metrics('histogram', histograms),
+        ))
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps({
+                'counters': [
+                    {'name': self.prefix + name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    {'name': self.prefix + name, 'labels': dict(labels), 'value': value, 'max': maximum}
+                    for (name, labels), (value, maximum) in sorted(self.gauges.items())
+                ],
+                'histograms': [
+                    {'name': self.prefix + name, 'labels': dict(labels), 'buckets': {str(bucket): cumulative_count for bucket, cumulative_count in self._get_cumulative_buckets(bucket_counts, count)}, 'sum': total, 'count': count}
+                    for (name, labels), (bucket_counts, total, count) in sorted(self.histograms.items())
+                ],
+            }, indent=4)
+
+
+class Trace:
+    # Spans of time recorded from any thread, which can be exported in the Chrome trace event
+    # format and opened in Perfetto or chrome://tracing. Spans are shown on the track of the
+    # thread they're recorded in, and must nest. Spans with an id can begin and end in different
+    # threads, and are shown on a track per id, nested in the other spans with the same id. Every
+    # span is kept in memory, so this is for profiling rather than for every run
+
+    def __init__(self):
+        self._events = []
+        self._thread_names = {}
+        self._thread_ids = itertools.count(1)
+        self._local = local()
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = Lock()
+
+    def now(self):
+        # In microseconds from when the trace started
+        return (time.perf_counter() - self._start) * 1000000
+
+    def _record(self, event):
+        # Thread idents are reused once a thread ends, so each thread is given its own id
+        with self._lock:
+            if not hasattr(self._local, 'tid'):
+                self._local.tid = next(self._thread_ids)
+                self._thread_names[self._local.tid] = current_thread().name
+            self._events.append({**event, 'pid': self._pid, 'tid': self._local.tid})
+
+    def add(self, name, start, /, **args):
+        # A span from start until now
+        self._record({'name': name, 'ph': 'X', 'ts': start, 'dur': self.now() - start, 'args': args})
+
+    @contextmanager
+    def span(self, name, /, **args):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, start, **args)
+
+    def begin(self, name, span_id, /, **args):
+        self._record({'name': name, 'cat': 'mirror', 'ph': 'b', 'id': span_id, 'ts': self.now(), 'args': args})
+
+    def end(self, name, span_id, /, **args):
+        self._record({'name': name, 'cat': 'mirror', 'ph': 'e', 'id': span_id, 'ts': self.now(), 'args': args})
+
+    def to_chrome_json(self):
+        with self._lock:
+            return json.dumps({
+                'traceEvents': [
+                    {'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in self._thread_names.items()
+                ] + self._events,
+                'displayTimeUnit': 'ms',
+            })
+
+
+class MeasuredStorage:
+    # Wraps a storage to record the number, errors and duration of each type of request. For
+    # streams, the duration is of the call and not of the consumption of the stream
+
+    def __init__(self, storage, metrics, labels):
+        self.storage = storage
+        self.metrics = metrics
+        self.labels = labels
+
+    def _measure(self, operation, func, *args):
+        labels = {**self.labels, 'operation': operation}
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except KeyError:
+            raise
+        except Exception:
+            self.metrics.inc('storage_request_errors_total', 1, labels)
+            raise
+        finally:
+            self.metrics.inc('storage_requests_total', 1, labels)
+            self.metrics.observe('storage_request_seconds', time.perf_counter() - start, labels)
+
+    def put(self, key, body):
+        return self._measure('put', self.storage.put, key, body)
+
+    def put_async(self, key, body):
+        # Recorded once the Future is done, so the duration includes the time in flight
+        labels = {**self.labels, 'operation': 'put_async'}
+        start = time.perf_counter()
+
+        def on_done(future):
+            if future.exception() is not None:
+                self.metrics.inc('storage_request_errors_total', 1, labels)
+            self.metrics.inc('storage_requests_total', 1, labels)
+            self.metrics.observe('storage_request_seconds', time.perf_counter() - start, labels)
+
+        future = self.storage.put_async(key, body)
+        future.add_done_callback(on_done)
+        return future
+
+    def put_stream(self, key, chunks):
+        return self._measure('put_stream', self.storage.put_stream, key, chunks)
+
+    @contextmanager
+    def put_parts(self, key):
+        # Each part is recorded as a request
+        with self.storage.put_parts(key) as put_part:
+            yield partial(self._measure, 'put_part', put_part)
+
+    def get_stream(self, key, start=None, end=None):
+        return self._measure('get_stream', self.storage.get_stream, key, start, end)
+
+    def get(self, key, start=None, end=None):
+        return self._measure('get', self.storage.get, key, start, end)
+
+    def copy(self, source_key, key, size_hint=None):
+        return self._measure('copy', self.storage.copy, source_key, key, size_hint)
+
+    def delete(self, keys):
+        return self._measure('delete', self.storage.delete, keys)
+
+    def exists(self, key):
+        return self._measure('exists', self.storage.exists, key)
+
+    def list(self, prefix):
+        # Recorded as a single request, excluding the time taken by whatever consumes the keys
+        labels = {**self.labels, 'operation': 'list'}
+        it = self.storage.list(prefix)
+        duration = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    key = next(it)
+                except StopIteration:
+                    break
+                except Exception:
+                    self.metrics.inc('storage_request_errors_total', 1, labels)
+                    raise
+                finally:
+                    duration += time.perf_counter() - start
+                yield key
+        finally:
+            self.metrics.inc('storage_requests_total', 1, labels)
+            self.metrics.observe('storage_request_seconds', duration, labels)
+
+
+class TracedStorage:
+    # Wraps a storage to record each request as a span. Puts from an event loop are in flight
+    # after the call returns, so they're recorded as spans with an id
+
+    def __init__(self, storage, trace, args):
+        self.storage = storage
+        self.trace = trace
+        self.args = args
+        self._put_ids = itertools.count()
+
+    def put(self, key, body):
+        with self.trace.span('put', key=key, size=len(body), **self.args):
+            return self.storage.put(key, body)
+
+    def put_async(self, key, body):
+        span_id = f'put {next(self._put_ids)}'
+        self.trace.begin('put_async', span_id, key=key, size=len(body), **self.args)
+        future = self.storage.put_async(key, body)
+        future.add_done_callback(lambda future: self.trace.end('put_async', span_id))
+        return future
+
+    def put_stream(self, key, chunks):
+        with self.trace.span('put_stream', key=key, **self.args):
+            return self.storage.put_stream(key, chunks)
+
+    @contextmanager
+    def put_parts(self, key):
+        def put_part(part_number, body):
+            with self.trace.span('put_part', key=key, part_number=part_number, size=len(body), **self.args):
+                return _put_part(part_number, body)
+
+        with self.storage.put_parts(key) as _put_part:
+            yield put_part
+
+    def get_stream(self, key, start=None, end=None):
+        with self.trace.span('get_stream', key=key, start=start, end=end, **self.args):
+            return self.storage.get_stream(key, start, end)
+
+    def get(self, key, start=None, end=None):
+        with self.trace.span('get', key=key, start=start, end=end, **self.args):
+            return self.storage.get(key, start, end)
+
+    def copy(self, source_key, key, size_hint=None):
+        with self.trace.span('copy', source_key=source_key, key=key, size=size_hint, **self.args):
+            return self.storage.copy(source_key, key, size_hint)
+
+    def delete(self, keys):
+        with self.trace.span('delete', **self.args):
+            return self.storage.delete(keys)
+
+    def exists(self, key):
+        with self.trace.span('exists', key=key, **self.args):
+            return self.storage.exists(key)
+
+    def list(self, prefix):
+        # Includes the time taken by whatever consumes the keys
+        with self.trace.span('list', prefix=prefix, **self.args):
+            yield from self.storage.list(prefix)
+
+
+class AdaptiveLimit:
+    # A limit on the number of requests in flight that's adjusted from how requests go. It starts
+    # low and doubles every round trip until the first request is throttled, and after that it
+    # grows by one every round trip and is multiplied by decrease_factor when a request is
+    # throttled. Requests sent before the last decrease can't cause another, so a burst of
+    # throttled requests only counts once. It also doesn't grow while requests take much longer
+    # than the fastest seen for their operation, since that suggests they're queueing somewhere,
+    # or while less than half of it is used, so it doesn't grow far beyond what's needed
+
+    decrease_factor = 0.7
+    latency_tolerance = 4.0
+
+    def __init__(self, maximum, initial=8, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = min(initial, maximum)
+        self._in_flight = 0
+        self._is_slow_start = True
+        self._last_decrease = time.monotonic()
+        self._min_latencies = {}
+        self._condition = Condition()
+
+    def acquire(self):
+        # Returns the time acquired, to pass to release
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return time.monotonic()
+
+    def release(self, operation, acquired, is_throttled, is_round_trip=True):
+        # A request that failed before it was sent isn't a round trip, so it neither grows the
+        # limit nor counts as the fastest seen
+        now = time.monotonic()
+        latency = now - acquired
+        with self._condition:
+            is_used = self._in_flight >= self.limit / 2
+            self._in_flight -= 1
+            if is_throttled:
+                if acquired > self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._is_slow_start = False
+                    self._last_decrease = now
+            elif is_round_trip:
+                min_latency = min(self._min_latencies.get(operation, latency), latency)
+                self._min_latencies[operation] = min_latency
+                if is_used and (latency <= min_latency * self.latency_tolerance or self._is_slow_start):
+                    self.limit = min(self.maximum, self.limit + (1 if self._is_slow_start else 1 / self.limit))
+            self._condition.notify_all()
+
+
+class AdaptiveStorage:
+    # Wraps a storage to limit the requests in flight by any number of AdaptiveLimit, for example
+    # one per repo and one shared by all, and to retry requests that are throttled after a backoff
+    # with full jitter. Streamed uploads and listings are neither limited nor retried, since they
+    # can't be replayed and are made of many requests that boto3 retries itself
+
+    backoff_base = 0.1
+    backoff_max = 20.0
+
+    def __init__(self, storage, limits, attempts, metrics=None, labels={}):
+        self.storage = storage
+        self.limits = limits
+        self.attempts = attempts
+        self.metrics = metrics
+        self.labels = labels
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _acquire(self):
+        return [limit.acquire() for limit in self.limits]
+
+    def _release(self, operation, acquired, e, is_round_trip=True):
+        is_throttled = e is not None and is_throttling_error(e)
+        for limit, limit_acquired in zip(self.limits, acquired):
+            limit.release(operation, limit_acquired, is_throttled, is_round_trip)
+        if self.metrics is not None and self.limits:
+            self.metrics.set('storage_requests_in_flight_limit', int(self.limits[-1].limit), self.labels)
+        if self.metrics is not None and is_throttled:
+            self.metrics.inc('storage_throttled_total', 1, {**self.labels, 'operation': operation})
+        return is_throttled
+
+    def _call(self, operation, func, *args):
+        for attempt in range(0, self.attempts):
+            acquired = self._acquire()
+            try:
+                result = func(*args)
+            except Exception as e:
+                if not self._release(operation, acquired, e) or attempt == self.attempts - 1:
+                    raise
+                time.sleep(self._backoff(attempt))
+            else:
+                self._release(operation, acquired, None)
+                return result
+
+    def put(self, key, body):
+        return self._call('put', self.storage.put, key, body)
+
+    def put_async(self, key, body):
+        # Retries are started by a timer rather than blocking the thread that calls this
+        result = Future()
+
+        def attempt(attempt_number):
+            acquired = self._acquire()
+
+            def on_done(e, is_round_trip=True):
+                if self._release('put_async', acquired, e, is_round_trip) and attempt_number < self.attempts - 1:
+                    Timer(self._backoff(attempt_number), attempt, (attempt_number + 1,)).start()
+                elif e is not None:
+                    result.set_exception(e)
+                else:
+                    result.set_result(None)
+
+            try:
+                future = self.storage.put_async(key, body)
+            except Exception as e:
+                on_done(e, is_round_trip=False)
+            else:
+                future.add_done_callback(lambda future: on_done(future.exception()))
+
+        attempt(0)
+        return result
+
+    def put_stream(self, key, chunks):
+        return self.storage.put_stream(key, chunks)
+
+    @contextmanager
+    def put_parts(self, key):
+        with self.storage.put_parts(key) as put_part:
+            yield partial(self._call, 'put_part', put_part)
+
+    def get_stream(self, key, start=None, end=None):
+        return self._call('get_stream', self.storage.get_stream, key, start, end)
+
+    def get(self, key, start=None, end=None):
+        return self._call('get', self.storage.get, key, start, end)
+
+    def copy(self, source_key, key, size_hint=None):
+        return self._call('copy', self.storage.copy, source_key, key, size_hint)
+
+    def delete(self, keys):
+        # The keys can be an iterator, so they're made into a list to retry
+        return self._call('delete', self.storage.delete, list(keys))
+
+    def exists(self, key):
+        return self._call('exists', self.storage.exists, key)
+
+    def list(self, prefix):
+        return self.storage.list(prefix)
+
+
+def get_default_storage(s3_client, scheme, netloc, s3_storage_class='STANDARD', async_s3_requests_in_flight=None, shared_requests_in_flight=None):
+    # The storage of a bucket or filesystem, or None if the scheme isn't supported
+    return \
+        AsyncS3Storage(s3_client, netloc, s3_storage_class, async_s3_requests_in_flight, shared_requests_in_flight) if scheme == 's3' and async_s3_requests_in_flight is not None else \
+        S3Storage(s3_client, netloc, s3_storage_class) if scheme == 's3' else \
+        FilesystemStorage(netloc or '/') if scheme == 'file' else \
+        None
+
+
 def mirror_repos(mappings,
         get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3)),
         get_s3_client=lambda: boto3.client('s3'),
         s3_storage_class="STANDARD",
+        get_storage=None,
         num_object_workers=10,
         num_lfs_workers=10,
         lfs_queue_size=10000,  # A queue item is small
+        lfs_batch_size=100,  # The most LFS objects in a batch call, which is the usual server limit
+        incremental=False,
+        storage_format='loose',
+        base_object_cache_size=67108864,  # In bytes
+        max_concurrent_repos=1,
+        max_s3_requests_in_flight=None,  # Across all repos, None for no limit
+        async_s3_requests_in_flight=None,  # Per bucket, of small objects put from an event loop, None to put them from the object workers
+        adaptive_requests_in_flight=None,  # Per repo, the most storage requests in flight, lowered when throttled, None for no limit
+        storage_attempts=5,  # Of each storage request that's throttled
+        max_http_connections=None,  # Across all repos, None for no limit
+        max_lfs_bytes_in_flight=None,  # Across all repos, None for no limit
+        include_refs=None,  # Patterns of refs to mirror, such as refs/heads/*, None for all
+        exclude_refs=(),  # Patterns of refs not to mirror, such as refs/pull/*
+        blob_size_limit=None,  # In bytes, larger blobs are not mirrored if the source supports it
+        num_object_processes=0,  # Processes to hash and compress small objects, 0 to do it in threads
+        max_object_bytes_in_flight=67108864,  # Across all repos, of objects parsed but not yet uploaded
+        max_pack_bytes_buffered=16777216,  # Per repo, of the pack received but not yet parsed
+        shared_objects_prefix=None,  # Within each target's bucket, where to store loose objects for all targets, None for each in its own
+        poll_interval=None,  # In seconds, to keep polling sources and mirror those whose refs have changed, None to mirror each once
+        max_polls_per_host_per_second=1.0,  # Requests for the refs of sources on each host, when polling
+        stop_polling=None,  # An Event to set to stop polling once the repos being mirrored have finished, None to poll indefinitely
+        metrics=None,  # A Metrics, or any object with the same inc, set and observe methods
+        trace=None,  # A Trace to record spans of the processing of each object in, None to not trace
     ):
 
-    def next_or_truncated_error(it):
-        try:
-            return next(it)
-        except StopIteration:
-            raise Exception('Truncated') from None
-
-    def get_reader(bytes_iter):
-        chunk = b''
-        offset = 0
-        it = iter(bytes_iter)
-
-        def _read(num_bytes):
-            nonlocal chunk, offset
+    def inc(name, value, **labels):
+        if metrics is not None:
+            metrics.inc(name, value, labels)
 
-            while num_bytes:
-                if offset == len(chunk):
-                    try:
-                        chunk = next_or_truncated_error(it)
-                    except StopIteration:
-                        break
-                    else:
-                        offset = 0
-                to_yield = min(num_bytes, len(chunk) - offset)
-                offset = offset + to_yield
-                num_bytes -= to_yield
-                yield chunk[offset - to_yield:offset]
+    def set_gauge(name, value, **labels):
+        if metrics is not None:
+            metrics.set(name, value, labels)
 
-        def yield_indefinite(num_bytes=float('infinity')):
-            yield from _read(num_bytes)
+    def observe(name, value, **labels):
+        if metrics is not None:
+            metrics.observe(name, value, labels)
 
-        def read_bytes(num_bytes):
-            return b''.join(_read(num_bytes))
+    def trace_span(name, /, **args):
+        return trace.span(name, **args) if trace is not None else nullcontext()
 
-        def return_unused(num_unused):
-            nonlocal offset
-            offset -= num_unused
+    def trace_begin(name, span_id, /, **args):
+        if trace is not None:
+            trace.begin(name, span_id, **args)
 
-        return yield_indefinite, read_bytes, return_unused
+    def trace_end(name, span_id, /, **args):
+        if trace is not None:
+            trace.end(name, span_id, **args)
 
-    def smooth(bytes_iter, interval=1.0):
+    def smooth(bytes_iter, repo, interval=1.0):
         # Due to deltas, our streaming processing can have large sections when we don't
         # fetch any data, and the remote can think we have gone away. To avoid, we make
-        # sure to pull every interval
+        # sure to pull every interval, but only until max_pack_bytes_buffered are waiting
+        # so a stalled parser can't make memory grow without limit
         it = iter(bytes_iter)
         thread_exception = None
         get_from_thread_exception = None
@@ -79,6 +1427,7 @@ def mirror_repos(mappings,
         queue = SimpleQueue()
         lock = Lock()
         amount_in_queue = 0
+        stopped = False
 
         def pull():
             nonlocal amount_in_queue, fetch_next, thread_exception
@@ -86,9 +1435,16 @@ def mirror_repos(mappings,
             try:
                 while True:
                     regular = fetch_next.wait(timeout=interval)
+                    if stopped:
+                        break
+                    with lock:
+                        is_full = amount_in_queue >= max_pack_bytes_buffered
+                    if not regular and is_full:
+                        continue
                     fetch_next.clear()
                     try:
-                        chunk = next(it)
+                        with trace_span('receive', repo=repo, forced=not regular):
+                            chunk = next(it)
                     except StopIteration:
                         queue.put(done)
                         break
@@ -96,7 +1452,9 @@ def mirror_repos(mappings,
                     with lock:
                         amount_in_queue += len_chunk
                         to_report = amount_in_queue  # To not print when holding the lock
+                    set_gauge('smooth_buffer_bytes', to_report, repo=repo)
                     if not regular:
+                        inc('smooth_forced_fetches_total', 1, repo=repo)
                         logger.info('Forced fetch to avoid HTTP timeout on server. In queue: %s', to_report)
                     queue.put(chunk)
                     chunk = None
@@ -108,106 +1466,83 @@ def mirror_repos(mappings,
 
         try:
             fetch_next.set()
+            wait_start = time.perf_counter()
             while chunk := queue.get(timeout=60):
+                inc('pack_receive_wait_seconds_total', time.perf_counter() - wait_start, repo=repo)
                 if chunk is done:
                     break
                 len_chunk = len(chunk)
                 with lock:
                     amount_in_queue -= len_chunk
+                inc('pack_bytes_received_total', len_chunk, repo=repo)
                 if queue.empty():
                     fetch_next.set()
                 yield chunk
                 chunk = None
+                wait_start = time.perf_counter()
             t.join(timeout=60)
         except Exception as e:
             get_from_thread_exception = e
+        finally:
+            # Including if the parser stopped early, so the thread doesn't wait for it forever
+            stopped = True
+            fetch_next.set()
 
         if thread_exception is not None:
             raise thread_exception
         elif get_from_thread_exception is not None:
             raise get_from_thread_exception
 
-    def uncompress_zlib(read_indefinite, return_unused):
+    def uncompress_zlib(read_indefinite, return_unused, repo):
+        # Metrics are totalled locally and recorded once per object, rather than once per chunk
         dobj = zlib.decompressobj()
+        num_bytes = 0
+        seconds = 0
 
-        for compressed_chunk in read_indefinite():
+        def decompress(compressed_chunk):
+            nonlocal num_bytes, seconds
+            start = time.perf_counter()
             uncompressed_chunk = dobj.decompress(compressed_chunk)
-            if uncompressed_chunk:
-                yield uncompressed_chunk
+            seconds += time.perf_counter() - start
+            num_bytes += len(uncompressed_chunk)
+            return uncompressed_chunk
 
-            while dobj.unconsumed_tail and not dobj.eof:
-                uncompressed_chunk = dobj.decompress(dobj.unconsumed_tail)
+        try:
+            for compressed_chunk in read_indefinite():
+                uncompressed_chunk = decompress(compressed_chunk)
                 if uncompressed_chunk:
                     yield uncompressed_chunk
 
-            if dobj.eof:
-                return_unused(len(dobj.unused_data))
-                break
+                while dobj.unconsumed_tail and not dobj.eof:
+                    uncompressed_chunk = decompress(dobj.unconsumed_tail)
+                    if uncompressed_chunk:
+                        yield uncompressed_chunk
 
-    def compress_zlib(chunks):
+                if dobj.eof:
+                    return_unused(len(dobj.unused_data))
+                    break
+        finally:
+            inc('decompressed_bytes_total', num_bytes, repo=repo)
+            inc('zlib_seconds_total', seconds, repo=repo, operation='decompress')
+
+    def compress_zlib(chunks, repo):
         cobj = zlib.compressobj()
-        for chunk in chunks:
-            compressed_chunk = cobj.compress(chunk)
-            if compressed_chunk:
+        num_bytes = 0
+        seconds = 0
+        try:
+            for chunk in chunks:
+                start = time.perf_counter()
+                compressed_chunk = cobj.compress(chunk)
+                seconds += time.perf_counter() - start
+                if compressed_chunk:
+                    num_bytes += len(compressed_chunk)
+                    yield compressed_chunk
+            if compressed_chunk := cobj.flush():
+                num_bytes += len(compressed_chunk)
                 yield compressed_chunk
-        if compressed_chunk := cobj.flush():
-            yield compressed_chunk
-
-    def to_filelike_obj(iterable):
-        chunk = b''
-        offset = 0
-        it = iter(iterable)
-
-        def up_to_iter(num):
-            nonlocal chunk, offset
-
-            while num:
-                if offset == len(chunk):
-                    try:
-                        chunk = next(it)
-                    except StopIteration:
-                        break
-                    else:
-                        offset = 0
-                to_yield = min(num, len(chunk) - offset)
-                offset = offset + to_yield
-                num -= to_yield
-                yield chunk[offset - to_yield:offset]
-
-        class FileLikeObj:
-            def read(self, n=-1):
-                n = \
-                    n if n != -1 else \
-                    float('infinity')
-                return b''.join(up_to_iter(n))
-
-        return FileLikeObj()
-
-    def get_object_type_and_length(read_bytes):
-        b = read_bytes(1)[0]
-
-        t = (b >> 4) & 7
-        length = (b & 15)
-        bits_to_shift_length = 4
-
-        while b & 128:
-            b = read_bytes(1)[0]
-            length += (b & 127) << bits_to_shift_length
-            bits_to_shift_length += 7
-
-        return t, length
-
-    def get_length(read_bytes):
-        bits_to_shift_length = 0
-        b = 128  # To enter the loop
-        length = 0
-
-        while b & 128:
-            b = read_bytes(1)[0]
-            length += (b & 127) << bits_to_shift_length
-            bits_to_shift_length += 7
-
-        return length
+        finally:
+            inc('compressed_bytes_total', num_bytes, repo=repo)
+            inc('zlib_seconds_total', seconds, repo=repo, operation='compress')
 
     def yield_with_asserted_length(bytes_iter, expected_length):
         length = 0
@@ -216,10 +1551,16 @@ def mirror_repos(mappings,
             yield chunk
         assert length == expected_length
 
-    def yield_with_sha(bytes_iter, sha):
-        for chunk in bytes_iter:
-            sha.update(chunk)
-            yield chunk
+    def yield_with_sha(bytes_iter, sha, repo):
+        seconds = 0
+        try:
+            for chunk in bytes_iter:
+                start = time.perf_counter()
+                sha.update(chunk)
+                seconds += time.perf_counter() - start
+                yield chunk
+        finally:
+            inc('sha1_seconds_total', seconds, repo=repo)
 
     def yield_with_lfs(bytes_iter):
         search_for = b'version https://git-lfs.github.com/spec/v1\n'
@@ -237,200 +1578,648 @@ def mirror_repos(mappings,
             return lfs_pointer_raw[:len(search_for)] == search_for
 
         def _lfs_pointer():
-            lfs_sha256 = None
-            lfs_size = None
-            for line in lfs_pointer_raw.splitlines():
-                key, value = line.split(b' ')
-                if key == b'oid':
-                    lfs_sha256 = line.split(b':')[1].decode()
-                if key == b'size':
-                    lfs_size = int(value.decode())
-            return lfs_sha256, lfs_size
+            return parse_lfs_pointer(lfs_pointer_raw)
 
         return _to_yield(), _is_lfs, _lfs_pointer
 
+    def yield_with_cache_put(bytes_iter, cache_put, get_key):
+        # The key is fetched at the end, since it can be the SHA of the bytes themselves
+        chunks = []
+        for chunk in bytes_iter:
+            chunks.append(chunk)
+            yield chunk
+        cache_put(get_key(), b''.join(chunks))
+
+    def yield_with_tee(bytes_iter, queue):
+        for chunk in bytes_iter:
+            queue.put(chunk)
+            yield chunk
+
+    def upload_in_thread(storage, key, chunks, transform=lambda chunks: chunks):
+        # Uploads from an iterable in a separate thread, returning a function that waits for the
+        # upload to finish and raises any exception from it
+        exceptions = []
+
+        def upload():
+            try:
+                storage.put_stream(key, transform(chunks))
+            except Exception as e:
+                exceptions.append(e)
+                # So whatever is producing the chunks doesn't block
+                for _ in chunks:
+                    pass
+
+        t = Thread(target=upload)
+        t.start()
+
+        def join():
+            t.join()
+            if exceptions:
+                raise exceptions[0]
+
+        return join
+
     def queue_to_iterable(queue):
         while value := queue.get():
             if value is done:
                 break
             yield value
 
-    def clear_tmp(s3_client, bucket, target_prefix):
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket, Prefix=f'{target_prefix}/mirror_tmp/'):
-            items = [
-                {'Key': item['Key']}
-                for item in page.get('Contents', [])
-            ]
-            if items:
-                s3_client.delete_objects(Bucket=bucket, Delete={'Objects': items})
+    def clear_tmp(storage, target_prefix):
+        storage.delete(storage.list(f'{target_prefix}/mirror_tmp/'))
 
     def get_refs(http_client, base_url):
-        r = http_client.request('GET', f'{base_url}/info/refs?service=git-upload-pack')
+        # Returns the protocol version, the ref HEAD points to, the server's capabilities, and
+        # (SHA, ref) pairs of the refs to mirror. Servers that support protocol v2 respond with
+        # their capabilities, and the refs are then requested with ls-refs, limited to the
+        # prefixes of the refs to mirror. Otherwise they respond with all their refs
+        with http_connections:
+            r = http_client.request('GET', f'{base_url}/info/refs?service=git-upload-pack', headers={'Git-Protocol': 'version=2'})
         r.raise_for_status()
-        lines = r.content.splitlines()
-        head_ref = re.match(b'.*symref=HEAD:(\\S+).*', lines[1]).group(1)
-        return head_ref, [
-            line.split()
-            for line in lines[2:-1]
+        lines = yield_pkt_lines((r.content,))
+        first_line = next(lines)
+        if first_line.startswith(b'# service='):
+            next(lines)
+            first_line = next(lines)
+
+        if first_line == b'version 2\n':
+            capabilities = set()
+            while (line := next(lines)) is not None:
+                capabilities.add(line.rstrip(b'\n'))
+            ref_prefixes = [re.split('[*?[]', pattern)[0] for pattern in include_refs or ()]
+            ls_refs_request = pkt_line(b'command=ls-refs\n') + b'0001' + pkt_line(b'symrefs\n') + pkt_line(b'peel\n') + (b''.join(
+                pkt_line(b'ref-prefix ' + ref_prefix.encode() + b'\n')
+                for ref_prefix in dict.fromkeys(['HEAD'] + ref_prefixes)
+            ) if ref_prefixes and all(ref_prefixes) else b'') + b'0000'
+            with http_connections:
+                r = http_client.post(f'{base_url}/git-upload-pack', content=ls_refs_request, headers={
+                    'Content-Type': 'application/x-git-upload-pack-request',
+                    'Git-Protocol': 'version=2',
+                })
+            r.raise_for_status()
+
+            protocol_version = 2
+            head_ref = None
+            refs = []
+            for line in yield_pkt_lines((r.content,)):
+                if line is None:
+                    break
+                sha, ref, *attributes = line.rstrip(b'\n').split(b' ')
+                attributes = dict(attribute.split(b':', 1) for attribute in attributes)
+                if ref == b'HEAD':
+                    head_ref = attributes.get(b'symref-target')
+                    continue
+                refs.append((sha, ref))
+                if b'peeled' in attributes:
+                    refs.append((attributes[b'peeled'], ref + b'^{}'))
+        else:
+            protocol_version = 0
+            first_ref, _, capabilities = first_line.rstrip(b'\n').partition(b'\x00')
+            head_ref = re.match(b'.*symref=HEAD:(\\S+).*', capabilities).group(1)
+            capabilities = set(capabilities.split())
+            refs = []
+            line = first_ref
+            while line is not None:
+                sha, ref = line.rstrip(b'\n').split(b' ')
+                if ref != b'HEAD':
+                    refs.append((sha, ref))
+                line = next(lines)
+
+        return protocol_version, head_ref, capabilities, [
+            (sha, ref)
+            for sha, ref in refs
+            if is_ref_included(ref)
+        ]
+
+    def is_ref_included(ref):
+        # Peeled tags are included with their tag
+        ref = ref.decode().removesuffix('^{}')
+        return \
+            (include_refs is None or any(fnmatchcase(ref, pattern) for pattern in include_refs)) and \
+            not any(fnmatchcase(ref, pattern) for pattern in exclude_refs)
+
+    def get_existing_refs(storage, target_prefix):
+        # The info/refs from a previous run, which is only written once all its objects have been
+        # uploaded, so everything reachable from these refs is already in the target
+        try:
+            existing_refs = storage.get(f'{target_prefix}/info/refs')
+        except KeyError:
+            return []
+        return [
+            line.split(b'\t')
+            for line in existing_refs.splitlines()
         ]
 
-    def upload_object(http_client, bucket, base_url, target_prefix, object_type, object_length, sha_lock, sha_events, shas, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, object_bytes):
+    def get_shared_haves(storage, objects_prefix):
+        # The SHAs of refs mirrored to targets that share the objects prefix, where everything
+        # reachable from them is in the objects prefix
+        try:
+            return storage.get(f'{objects_prefix}/info/mirror-git-to-s3-haves').splitlines()
+        except KeyError:
+            return []
+
+    def add_shared_haves(storage, objects_prefix, shas):
+        # Only the most recent are kept, to limit the size of requests. Concurrent runs can
+        # overwrite each other's additions, which only means less is saved on later forks
+        storage.put(f'{objects_prefix}/info/mirror-git-to-s3-haves', b''.join(
+            sha + b'\n'
+            for sha in list(dict.fromkeys(get_shared_haves(storage, objects_prefix) + shas))[-shared_haves_max:]
+        ))
+
+    def pkt_line(data):
+        return b'%04x' % (len(data) + 4) + data
+
+    def upload_existing_object_as_raw(storage, base_url, target_prefix, objects_prefix, complete, sha):
+        # In a thin pack deltas can be against objects that are not in the pack, but are from a
+        # previous run. If so, put the uncompressed version where deltas expect base objects
+        sha_hex = sha.hex()
+        try:
+            compressed_bytes = storage.get_stream(f'{objects_prefix}/{sha_hex[0:2]}/{sha_hex[2:]}')
+        except KeyError:
+            return
+
+        logger.debug('Using object from previous run as delta base %s', sha_hex)
+        yield_indefinite, _, _, return_unused, _ = get_reader(compressed_bytes)
+        yield_indefinite, _, read_byte, _, _ = get_reader(uncompress_zlib(yield_indefinite, return_unused, base_url))
+        object_type_name, object_length = bytes(iter(read_byte, 0)).split(b' ')
+        object_type = types_for_name[object_type_name]
+        object_bytes = yield_indefinite(int(object_length))
+        if int(object_length) <= base_object_cache_max_object_size:
+            object_bytes = yield_with_cache_put(object_bytes, base_object_cache_put, lambda: sha)
+        storage.put_stream(f'{target_prefix}/mirror_tmp/raw/{sha_hex}', object_bytes)
+        complete(None, sha, object_type)
+
+    def get_existing_object(storage, base_url, objects_prefix, sha):
+        # The bytes of a small object already in the target, without its type and length prefix
+        sha_hex = sha.hex()
+        compressed_bytes = storage.get(f'{objects_prefix}/{sha_hex[0:2]}/{sha_hex[2:]}')
+        yield_indefinite, _, _, return_unused, _ = get_reader((compressed_bytes,))
+        prefixed_bytes = b''.join(uncompress_zlib(yield_indefinite, return_unused, base_url))
+        return prefixed_bytes[prefixed_bytes.index(b'\x00') + 1:]
+
+    def is_raw_needed(object_length):
+        # In loose mode deltas read their bases from the raw versions of objects. In pack mode
+        # bases that are no longer cached are read from the pack once it's stored instead, apart
+        # from those too large to cache, which would otherwise be read into memory whole
+        return storage_format == 'loose' or object_length > base_object_cache_max_object_size
+
+    def upload_object(http_client, storage, base_url, target_prefix, objects_prefix, is_existing_object, add_uploaded_object, object_type, object_length, complete, pack_offset, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, object_bytes):
         binary_prefix = types_names_for_hash[object_type] + b' ' + str(object_length).encode() + b'\x00'
         sha = sha1(binary_prefix)
-        temp_file_name =  f'{target_prefix}/mirror_tmp/{str(uuid.uuid4())}'
-        with_sha = yield_with_sha(object_bytes, sha)
+        with_sha = yield_with_sha(object_bytes, sha, base_url)
         with_lfs_check, is_lfs, lfs_pointer = yield_with_lfs(with_sha)
 
-        if object_length < 65536:
+        if object_length < 65536 and process_object is not None:
+            all_bytes = b''.join(object_bytes)
+            sha_digest, compressed_and_prefixed, lfs = process_object(types_names_for_hash[object_type], all_bytes, storage_format == 'loose')
+            get_compressed_and_prefixed = lambda: compressed_and_prefixed
+            is_lfs = lambda: lfs is not None
+            lfs_pointer = lambda: lfs
+        elif object_length < 65536:
             all_bytes = b''.join(with_lfs_check)
-            sha_hex = sha.hexdigest()
-            s3_client.put_object(Bucket=bucket, Key=f'{target_prefix}/mirror_tmp/raw/{sha_hex}', Body=all_bytes, StorageClass=s3_storage_class)
+            sha_digest = sha.digest()
+            get_compressed_and_prefixed = lambda: b''.join(compress_zlib(itertools.chain((binary_prefix,), (all_bytes,)), base_url))
+
+        def on_uploaded():
+            object_bar.update(1)
+            inc('objects_total', 1, repo=base_url, type=types_names_for_hash[object_type].decode())
 
-            with sha_lock:
-                shas[sha.digest()] = object_type
-                sha_events[sha.digest()].set()
+            if not is_lfs():
+                return
+            lfs_sha256, lfs_size = lfs_pointer()
+            with lfs_bar_lock:
+                lfs_bar.total = (lfs_bar.total or 0) + lfs_size
+            lfs_queue.put((lfs_sha256, lfs_size))
+            set_gauge('queue_depth', lfs_queue.qsize(), repo=base_url, queue='lfs')
 
-            compressed_and_prefixed = b''.join(compress_zlib(itertools.chain((binary_prefix,), (all_bytes,))))
-            s3_client.put_object(Bucket=bucket, Key=f'{target_prefix}/objects/{sha_hex[0:2]}/{sha_hex[2:]}', Body=compressed_and_prefixed, StorageClass=s3_storage_class)
+        if object_length < 65536:
+            sha_hex = sha_digest.hex()
+            # A small object already in the target is not uploaded at all, and deltas against it
+            # read it from the target rather than from the raw version
+            is_existing = is_existing_object(sha_digest)
+            if object_length <= base_object_cache_max_object_size:
+                base_object_cache_put(sha_digest, all_bytes)
+
+            # If the storage makes requests asynchronously, the worker moves on to the next object
+            # while the raw and loose versions are in flight, and the rest is done once they're
+            # stored. Returning a Future keeps the job counted as running until then
+            raw_put = \
+                storage.put_async(f'{target_prefix}/mirror_tmp/raw/{sha_hex}', all_bytes) if not is_existing and is_raw_needed(object_length) else \
+                completed_future(lambda: None)
+            completed = after_all([raw_put], partial(complete, pack_offset, sha_digest, object_type))
+
+            if storage_format == 'loose' and not is_existing:
+                loose_put = storage.put_async(f'{objects_prefix}/{sha_hex[0:2]}/{sha_hex[2:]}', get_compressed_and_prefixed())
+                loose_put.add_done_callback(lambda future: add_uploaded_object(sha_digest) if future.exception() is None else None)
+            else:
+                loose_put = completed_future(lambda: None)
+            if is_existing:
+                inc('objects_existing_total', 1, repo=base_url)
+
+            return after_all([completed, loose_put], on_uploaded)
         else:
-            temp_file_name =  f'{target_prefix}/mirror_tmp/{str(uuid.uuid4())}'
-            s3_client.upload_fileobj(to_filelike_obj(with_lfs_check), Bucket=bucket, Key=temp_file_name, ExtraArgs={'StorageClass': s3_storage_class})
+            if object_length <= base_object_cache_max_object_size:
+                with_lfs_check = yield_with_cache_put(with_lfs_check, base_object_cache_put, sha.digest)
+
+            # The SHA isn't known until all the bytes have been seen, so the raw and the prefixed
+            # and compressed versions are uploaded concurrently to temporary keys, and then copied
+            temp_file_name = f'{target_prefix}/mirror_tmp/{str(uuid.uuid4())}'
+            compressed_temp_file_name = f'{target_prefix}/mirror_tmp/{str(uuid.uuid4())}'
+            if storage_format == 'loose':
+                compressed_queue = Queue(maxsize=16)
+                join_compressed = upload_in_thread(storage, compressed_temp_file_name, queue_to_iterable(compressed_queue), lambda chunks: compress_zlib(itertools.chain((binary_prefix,), chunks), base_url))
+                with_lfs_check = yield_with_tee(with_lfs_check, compressed_queue)
+            try:
+                if is_raw_needed(object_length):
+                    storage.put_stream(temp_file_name, with_lfs_check)
+                else:
+                    for _ in with_lfs_check:
+                        pass
+            finally:
+                if storage_format == 'loose':
+                    compressed_queue.put(done)
+                    join_compressed()
             sha_hex = sha.hexdigest()
-            s3_client.copy(CopySource={
-                'Bucket': bucket,
-                'Key': temp_file_name,
-            }, Bucket=bucket, Key=f'{target_prefix}/mirror_tmp/raw/{sha_hex}', ExtraArgs={'StorageClass': s3_storage_class})
-
-            with sha_lock:
-                shas[sha.digest()] = object_type
-                sha_events[sha.digest()].set()
-
-            s3_client.delete_object(Bucket=bucket, Key=temp_file_name)
-
-            # Upload in prefixed and compressed format to final location
-            resp = s3_client.get_object(Bucket=bucket, Key=f'{target_prefix}/mirror_tmp/raw/{sha_hex}')
-            s3_client.upload_fileobj(to_filelike_obj(compress_zlib(itertools.chain((binary_prefix,), resp['Body']))), Bucket=bucket, Key=f'{target_prefix}/objects/{sha_hex[0:2]}/{sha_hex[2:]}', ExtraArgs={'StorageClass': s3_storage_class})
-
-        object_bar.update(1)
-
-        if not is_lfs():
+            if is_raw_needed(object_length):
+                storage.copy(temp_file_name, f'{target_prefix}/mirror_tmp/raw/{sha_hex}', size_hint=object_length)
+
+            complete(pack_offset, sha.digest(), object_type)
+
+            if storage_format == 'loose' and not is_existing_object(sha.digest()):
+                storage.copy(compressed_temp_file_name, f'{objects_prefix}/{sha_hex[0:2]}/{sha_hex[2:]}', size_hint=object_length)
+                add_uploaded_object(sha.digest())
+            elif storage_format == 'loose':
+                inc('objects_existing_total', 1, repo=base_url)
+
+            if is_raw_needed(object_length):
+                storage.delete((temp_file_name, compressed_temp_file_name) if storage_format == 'loose' else (temp_file_name,))
+            on_uploaded()
+
+    def get_base_ranges(copies):
+        # Copies that overlap or are close together in the base are fetched in a single request
+        ranges = []
+        for offset, size in sorted(copies):
+            if ranges and offset <= ranges[-1][1] + base_range_max_gap and max(ranges[-1][1], offset + size) - ranges[-1][0] <= base_range_max_size:
+                ranges[-1][1] = max(ranges[-1][1], offset + size)
+            else:
+                ranges.append([offset, offset + size])
+        return ranges
+
+    def yield_object_bytes_from_delta(storage, target_prefix, base_sha, base_object, instructions):
+        # If the base is in memory, copies from it are sliced from memoryviews, so they aren't
+        # copied until they're uploaded
+        if base_object is not None:
+            yield from yield_delta_target(base_object, instructions)
             return
-        lfs_sha256, lfs_size = lfs_pointer()
-        with lfs_bar_lock:
-            lfs_bar.total = (lfs_bar.total or 0) + lfs_size
-        lfs_queue.put(partial(upload_lfs, s3_client, http_client, bucket, target_prefix, base_url, lfs_bar, lfs_sha256, lfs_size))
-
-    def construct_object_from_delta_and_upload(s3_client, bucket, base_url, target_prefix, sha_lock, sha_events, shas, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, base_sha, delta_bytes):
-        yield_indefinite, read_bytes, return_unused = get_reader(delta_bytes)
-        base_size = get_length(read_bytes)
-        target_size = get_length(read_bytes)
-
-        def read_sparse(instruction, instruction_bit_range):
-            value = 0
-            factor = 0
-            for b in instruction_bit_range:
-                has = (instruction >> b) & 1
-                if has:
-                    value += read_bytes(1)[0] << factor
-                factor += 8
-            return value
-
-        def yield_object_bytes():
-            # Latency to S3 is quite high, so we cache chunks of the base object in an LRU cache
-            # to avoid lots of small fetches
-            caches = deque((
-                (0, '')
-                for _ in range(0, 16)
-            ))
 
-            target_size_remaining = target_size
-            while target_size_remaining:
-                instruction = read_bytes(1)[0]
-                assert instruction != 0
-
-                # Explict bytes in the instruction
-                if not (instruction >> 7):
-                    size = instruction & 127
-                    target_size_remaining -= size
-                    yield from yield_indefinite(size)
+        # If not, latency to storage is quite high, so the ranges of the raw version of the base
+        # that are needed are requested concurrently, in the order they are first needed and with
+        # a bounded number ahead of the one being used. Each is released after its last use
+        key = f'{target_prefix}/mirror_tmp/raw/{base_sha.hex()}'
+        copies = [
+            (offset, size)
+            for offset, size, _ in instructions
+            if offset is not None
+        ]
+        ranges = get_base_ranges(copies)
+        range_starts = [start for start, end in ranges]
+        copy_ranges = [bisect_right(range_starts, offset) - 1 for offset, _ in copies]
+        ranges_in_order_needed = list(dict.fromkeys(copy_ranges))
+        range_positions = {range_index: position for position, range_index in enumerate(ranges_in_order_needed)}
+        range_last_uses = {range_index: copy_index for copy_index, range_index in enumerate(copy_ranges)}
+
+        with ThreadPoolExecutor(max_workers=base_ranges_in_flight) as executor:
+            futures = {}
+            num_requested = 0
+            copy_index = 0
+
+            for offset, size, chunks in instructions:
+                if offset is None:
+                    yield from chunks
                     continue
 
-                offset = read_sparse(instruction, range(0, 4))
-                size = read_sparse(instruction, range(4, 7)) or 65536
-                sha_hex = base_sha.hex()
+                range_index = copy_ranges[copy_index]
+                while num_requested < min(range_positions[range_index] + base_ranges_in_flight, len(ranges_in_order_needed)):
+                    start, end = ranges[ranges_in_order_needed[num_requested]]
+                    futures[ranges_in_order_needed[num_requested]] = executor.submit(storage.get, key, start, end)
+                    num_requested += 1
+
+                base_range = memoryview(futures[range_index].result())
+                range_offset = offset - ranges[range_index][0]
+                yield from yield_with_asserted_length((base_range[range_offset:range_offset + size],), size)
+
+                if range_last_uses[range_index] == copy_index:
+                    del futures[range_index]
+                copy_index += 1
+
+    def get_object_from_pack(storage, base_url, target_prefix, pack_key, pack_end, get_pack_entry, base_key):
+        # The bytes of an object in a stored pack, found by ('offset', <offset>) or ('sha', <SHA>).
+        # If it's a delta, its base is from the cache or from the pack in the same way, unless it's
+        # too large to cache and so has a raw version. Each object read is cached
+        pack_offset, next_pack_offset, sha = get_pack_entry(base_key)
+        entry = storage.get(pack_key, pack_offset, next_pack_offset if next_pack_offset is not None else pack_end)
+        yield_indefinite, read_bytes, read_byte, return_unused, _ = get_reader((entry,))
+        object_type, object_length = get_object_type_and_length(read_byte)
+        entry_base_key = \
+            ('offset', pack_offset - get_negative_offset(read_byte)) if object_type == 6 else \
+            ('sha', read_bytes(20)) if object_type == 7 else \
+            None
+        object_bytes = yield_with_asserted_length(uncompress_zlib(yield_indefinite, return_unused, base_url), object_length)
+
+        if entry_base_key is not None:
+            base_size, _, instructions = get_delta_instructions(object_bytes, base_range_max_size)
+            _, _, base_sha = get_pack_entry(entry_base_key)
+            base_object = base_object_cache_get(base_sha)
+            if base_object is None and not is_raw_needed(base_size):
+                base_object = get_object_from_pack(storage, base_url, target_prefix, pack_key, pack_end, get_pack_entry, entry_base_key)
+            object_bytes = yield_object_bytes_from_delta(storage, target_prefix, base_sha, base_object, instructions)
+
+        object_bytes = b''.join(object_bytes)
+        base_object_cache_put(sha, object_bytes)
+        return object_bytes
+
+    def construct_object_from_delta_and_upload(storage, base_url, target_prefix, objects_prefix, is_existing_object, add_uploaded_object, add_delta, defer_delta, get_pack_object, complete, claim_base, get_object_type, pack_offset, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, base_sha, base_pack_offset, delta_bytes):
+        base_size, target_size, instructions = get_delta_instructions(delta_bytes, base_range_max_size)
+        decoded = time.perf_counter()
+
+        def upload_with_base(base_sha):
+            # Recently uploaded objects are likely to still be in memory
+            base_object = base_object_cache_get(base_sha)
+            if base_object is None and base_size < 65536 and is_existing_object(base_sha):
+                base_object = get_existing_object(storage, base_url, objects_prefix, base_sha)
+
+            # A base without a raw version is read from the pack, so if the pack is not yet
+            # stored, the delta waits until it is
+            if base_object is None and not is_raw_needed(base_size):
+                if defer_delta(pack_offset, partial(upload_with_base, base_sha)):
+                    return
+                base_object = get_pack_object(('offset', base_pack_offset) if base_pack_offset is not None else ('sha', base_sha))
+
+            observe('delta_base_wait_seconds', time.perf_counter() - decoded, repo=base_url)
+            return upload_object(http_client, storage, base_url, target_prefix, objects_prefix, is_existing_object, add_uploaded_object, get_object_type(base_sha), target_size, complete, pack_offset, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, yield_object_bytes_from_delta(storage, target_prefix, base_sha, base_object, instructions))
+
+        # If the pack is thin, the base may be from a previous run rather than in the pack, so the
+        # first delta against a base that's not been uploaded yet tries to make it available
+        if base_sha is not None and claim_base(base_sha):
+            upload_existing_object_as_raw(storage, base_url, target_prefix, objects_prefix, complete, base_sha)
+
+        # An OBJ_OFS_DELTA refers to its base by its position in the pack, and an OBJ_REF_DELTA by
+        # its SHA. Either way, it's uploaded by a worker once the base has been
+        add_delta(pack_offset, ('offset', base_pack_offset) if base_sha is None else ('sha', base_sha), upload_with_base)
+
+    def get_lfs_download_actions(http_client, base_url, lfs_pointers):
+        # The download action of each LFS object, requested in as few batch calls as possible. If
+        # the server says a batch is too large, it's split in half
+        if not lfs_pointers:
+            return {}
+        with trace_span('lfs batch', repo=base_url, objects=len(lfs_pointers)), http_connections:
+            batch_response = http_client.post(base_url.removesuffix('.git') + '.git/info/lfs/objects/batch', json={
+                'operation': 'download',
+                'objects': [{'oid': lfs_sha256, 'size': lfs_size} for lfs_sha256, lfs_size in lfs_pointers]
+            }, headers={
+                'Accept': 'application/vnd.git-lfs+json',
+                'Content-Type': 'application/vnd.git-lfs+json',
+            })
+        inc('lfs_batch_requests_total', 1, repo=base_url)
+        if batch_response.status_code == 413 and len(lfs_pointers) > 1:
+            half = len(lfs_pointers) // 2
+            return {
+                **get_lfs_download_actions(http_client, base_url, lfs_pointers[:half]),
+                **get_lfs_download_actions(http_client, base_url, lfs_pointers[half:]),
+            }
+        batch_response.raise_for_status()
 
-                # If the size is bigger than 64KiB, we don't cache and just stream
-                # - this is actually quite rare for source code
-                if size >= 65536:
-                    resp = s3_client.get_object(Bucket=bucket, Key=f'{target_prefix}/mirror_tmp/raw/{sha_hex}', Range='bytes={}-{}'.format(offset, offset + size - 1))
-                    target_size_remaining -= size
-                    yield from yield_with_asserted_length(resp['Body'], size)
-                    continue
+        actions = {}
+        for obj in batch_response.json()['objects']:
+            if 'error' in obj:
+                raise Exception(f'Unable to download LFS object {obj["oid"]}: {obj["error"].get("message")}')
+            actions[obj['oid']] = obj['actions']['download']
+        return actions
+
+    def retry_lfs_download(http_client, base_url, lfs_sha256, lfs_size, download_action, download):
+        # Calls download with the download action, and if it fails, again with a fresh action
+        # since its URL may have expired
+        for attempt in range(0, lfs_download_attempts):
+            try:
+                return download(download_action)
+            except httpx.HTTPError:
+                if attempt == lfs_download_attempts - 1:
+                    raise
+                logger.exception('Retrying LFS download %s', lfs_sha256)
+                inc('lfs_download_retries_total', 1, repo=base_url)
+                time.sleep(2 ** attempt)
+                download_action = get_lfs_download_actions(http_client, base_url, [(lfs_sha256, lfs_size)])[lfs_sha256]
+
+    def yield_lfs_data(http_client, lfs_bar, lfs_sha256, lfs_size, download_action):
+        # The last chunk is only yielded once the SHA-256 has been checked, so nothing is stored
+        # if it doesn't match
+        sha = sha256()
+        num_bytes = 0
+        try:
+            with http_connections, http_client.stream('GET', download_action['href'], headers=download_action.get('header', {})) as bytes_response:
+                bytes_response.raise_for_status()
+                previous_chunk = None
+                for chunk in bytes_response.iter_bytes():
+                    if previous_chunk is not None:
+                        yield previous_chunk
+                    sha.update(chunk)
+                    previous_chunk = chunk
+                    num_bytes += len(chunk)
+                    lfs_bar.update(len(chunk))
+                if num_bytes != lfs_size or sha.hexdigest() != lfs_sha256:
+                    raise Exception(f'LFS object {lfs_sha256} does not match its pointer')
+                if previous_chunk is not None:
+                    yield previous_chunk
+        except BaseException:
+            lfs_bar.update(-num_bytes)
+            raise
+
+    def upload_lfs_in_ranges(storage, http_client, key, base_url, lfs_bar, lfs_sha256, lfs_size, download_action):
+        # Ranges are downloaded concurrently, each put as a part of a multipart upload as soon as
+        # it's downloaded, with a bounded number in flight. The SHA-256 is computed as they're
+        # downloaded in order, and the upload is only completed if it matches
+        range_size = max(lfs_range_size, -(-lfs_size // 10000))  # At most 10000 parts
+
+        def download_range(start, end, download_action):
+            with trace_span('lfs range', repo=base_url, sha256=lfs_sha256, start=start, end=end), http_connections, http_client.stream('GET', download_action['href'], headers={
+                **download_action.get('header', {}),
+                'Range': f'bytes={start}-{end - 1}',
+            }) as range_response:
+                range_response.raise_for_status()
+                if range_response.status_code != 206:
+                    raise RangesNotSupported()
+                range_bytes = range_response.read()
+            if len(range_bytes) != end - start:
+                raise Exception(f'LFS object {lfs_sha256} does not match its pointer')
+            return range_bytes
+
+        def download_and_put_part(part_number, start, end):
+            range_bytes = retry_lfs_download(http_client, base_url, lfs_sha256, lfs_size, download_action, partial(download_range, start, end))
+            put_part(part_number, range_bytes)
+            return range_bytes
+
+        sha = sha256()
+        num_bytes = 0
+
+        def update_sha(future):
+            nonlocal num_bytes
+            range_bytes = future.result()
+            sha.update(range_bytes)
+            num_bytes += len(range_bytes)
+            lfs_bar.update(len(range_bytes))
+
+        # If this fails, say because a later range isn't supported, the object may be downloaded
+        # again in full, so the ranges downloaded so far are taken off the progress
+        try:
+            with storage.put_parts(key) as put_part, ThreadPoolExecutor(max_workers=lfs_ranges_in_flight) as executor:
+                futures = deque()
+                for part_number, start in enumerate(range(0, lfs_size, range_size), start=1):
+                    futures.append(executor.submit(download_and_put_part, part_number, start, min(start + range_size, lfs_size)))
+                    if len(futures) == lfs_ranges_in_flight:
+                        update_sha(futures.popleft())
+                while futures:
+                    update_sha(futures.popleft())
+                if sha.hexdigest() != lfs_sha256:
+                    raise Exception(f'LFS object {lfs_sha256} does not match its pointer')
+        except BaseException:
+            lfs_bar.update(-num_bytes)
+            raise
+
+    def upload_lfs(storage, http_client, target_prefix, base_url, lfs_bar, lfs_sha256, lfs_size, download_action):
+        logger.debug('Uploading LFS %s %s', lfs_sha256, lfs_size)
+        key = f'{target_prefix}/lfs/objects/' + lfs_sha256[0:2] + '/' + lfs_sha256[2:4] + '/' + lfs_sha256
+        with trace_span('lfs object', repo=base_url, sha256=lfs_sha256, size=lfs_size), lfs_bytes_in_flight(lfs_size):
+            start = time.perf_counter()
+            # Large objects are downloaded in ranges if the server supports it
+            is_uploaded = False
+            if lfs_size > lfs_range_size:
+                try:
+                    upload_lfs_in_ranges(storage, http_client, key, base_url, lfs_bar, lfs_sha256, lfs_size, download_action)
+                    is_uploaded = True
+                except RangesNotSupported:
+                    logger.debug('LFS server does not support ranges %s', lfs_sha256)
+            if not is_uploaded:
+                retry_lfs_download(http_client, base_url, lfs_sha256, lfs_size, download_action, lambda download_action: storage.put_stream(
+                    key, yield_lfs_data(http_client, lfs_bar, lfs_sha256, lfs_size, download_action),
+                ))
+            # The download and upload are streamed together, so the throughput is of both
+            inc('lfs_files_total', 1, repo=base_url, outcome='uploaded')
+            inc('lfs_bytes_total', lfs_size, repo=base_url)
+            inc('lfs_seconds_total', time.perf_counter() - start, repo=base_url)
+        logger.debug('Uploaded %s %s', lfs_sha256, lfs_size)
 
-                # If the size is less than 64KiB, we fetch in 64KiB chunks and save in a LRU cache
-                for i, (cache_start, cache) in enumerate(caches):
-                    if cache_start <= offset and offset + size < cache_start + len(cache):
-                        del caches[i]
-                        caches.appendleft((cache_start, cache))
+    def batch_lfs_pointers(storage, http_client, target_prefix, base_url, lfs_bar, lfs_queue, lfs_download_queue, exceptions):
+        # LFS pointers are gathered into batches, so one batch call resolves many of them. Which
+        # LFS objects are already in the target is found by listing them all when the first
+        # pointer is seen, rather than one request per object
+        existing_lfs_sha256s = None
+        seen_lfs_sha256s = set()
+        is_done = False
+
+        while not is_done:
+            lfs_pointers = []
+            try:
+                item = lfs_queue.get()
+                while item is not done:
+                    lfs_pointers.append(item)
+                    if len(lfs_pointers) == lfs_batch_size:
                         break
-                else:
-                    middle = offset + (size // 2)
-                    cache_a_start = max(middle - 32768, 0)
-                    provisional_cache_end = cache_a_start + 65536
-                    resp = s3_client.get_object(Bucket=bucket, Key=f'{target_prefix}/mirror_tmp/raw/{sha_hex}', Range='bytes={}-{}'.format(cache_a_start, provisional_cache_end - 1))
-                    cache_a = resp['Body'].read()
-                    cache_start = cache_a_start
-                    cache = cache_a
-                    caches.pop()
-                    caches.appendleft((cache_start, cache))
-
-                target_size_remaining -= size
-                yield from yield_with_asserted_length((cache[offset - cache_start:offset - cache_start + size],), size)
-
-            # Not expecting any bytes - this is to exhaust the iterator to put back bytes after zlib
-            for _ in delta_bytes:
-                pass
+                    try:
+                        item = lfs_queue.get(timeout=lfs_batch_wait)
+                    except Empty:
+                        break
+                is_done = item is done
 
-        # Wait to make sure the base object has been uploaded
-        with sha_lock:
-            sha_event = sha_events[base_sha]
-        sha_event.wait()
-        with sha_lock:
-            object_type = shas[base_sha]
+                if existing_lfs_sha256s is None and lfs_pointers:
+                    existing_lfs_sha256s = set(
+                        key.rpartition('/')[2]
+                        for key in storage.list(f'{target_prefix}/lfs/objects/')
+                    )
 
-        upload_object(http_client, bucket, base_url, target_prefix, object_type, target_size, sha_lock, sha_events, shas, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, yield_object_bytes())
+                to_download = []
+                for lfs_sha256, lfs_size in lfs_pointers:
+                    if lfs_sha256 in existing_lfs_sha256s or lfs_sha256 in seen_lfs_sha256s:
+                        lfs_bar.update(lfs_size)
+                        inc('lfs_files_total', 1, repo=base_url, outcome='skipped')
+                        logger.debug('LFS exists, skipping %s', lfs_sha256)
+                    else:
+                        to_download.append((lfs_sha256, lfs_size))
+                    seen_lfs_sha256s.add(lfs_sha256)
 
-    def yield_lfs_data(http_client, bucket, base_url, lfs_bar, lfs_sha256, lfs_size):
-        batch_response = http_client.post(base_url.removesuffix('.git') + '.git/info/lfs/objects/batch', json={
-            'operation': 'download',
-            'objects': [{'oid': lfs_sha256, 'size': lfs_size}]
-        })
-        batch_response.raise_for_status()
-        download_href = batch_response.json()['objects'][0]['actions']['download']['href']
+                download_actions = get_lfs_download_actions(http_client, base_url, to_download)
+                for lfs_sha256, lfs_size in to_download:
+                    lfs_download_queue.put(partial(upload_lfs, storage, http_client, target_prefix, base_url, lfs_bar, lfs_sha256, lfs_size, download_actions[lfs_sha256]))
+            except Exception as e:
+                logger.exception('Exception in thread')
+                exceptions.append(e)
 
-        with httpx.stream('GET', download_href) as bytes_response:
-            for chunk in bytes_response.iter_bytes():
-                yield chunk
-                lfs_bar.update(len(chunk))
+        for _ in range(0, num_lfs_workers):
+            lfs_download_queue.put(done)
 
-    def upload_lfs(s3_client, http_client, bucket, target_prefix, base_url, lfs_bar, lfs_sha256, lfs_size):
-        logger.debug('Uploading LFS %s %s', lfs_sha256, lfs_size)
-        key = f'{target_prefix}/lfs/objects/' + lfs_sha256[0:2] + '/' + lfs_sha256[2:4] + '/' + lfs_sha256
+    def upload_pack(storage, key, pack_bytes, exceptions):
         try:
-            s3_client.head_object(Bucket=bucket, Key=key)
-        except s3_client.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != '404':
-                raise
-        else:
-            lfs_bar.update(lfs_size)
-            logger.debug('LFS exists, skipping %s', lfs_sha256)
-            return
-        lfs_data = yield_lfs_data(http_client, bucket, base_url, lfs_bar, lfs_sha256, lfs_size)
-        s3_client.upload_fileobj(to_filelike_obj(lfs_data), Bucket=bucket, Key=key, ExtraArgs={'StorageClass': s3_storage_class})
-        logger.debug('Uploaded %s %s', lfs_sha256, lfs_size)
+            storage.put_stream(key, pack_bytes)
+        except Exception as e:
+            logger.exception('Exception uploading pack')
+            exceptions.append(e)
+            # So the parser doesn't block waiting for us
+            for _ in pack_bytes:
+                pass
 
-    def worker_func(q):
+    def get_pack_index(pack_objects, pack_sha):
+        # Version 2 .idx file: a fanout table by first byte of SHA, then SHAs in sorted order,
+        # then the CRC32 and offset in the pack of each, with large offsets in a separate table
+        pack_objects = sorted(pack_objects)
+        fanout = [0] * 256
+        for sha, crc, offset in pack_objects:
+            fanout[sha[0]] += 1
+        large_offsets = [
+            offset
+            for sha, crc, offset in pack_objects
+            if offset >= 0x80000000
+        ]
+        large_offsets_indexes = {
+            offset: i
+            for i, offset in enumerate(large_offsets)
+        }
+        index = \
+            b'\xfftOc' + pack('>I', 2) + \
+            pack('>256I', *itertools.accumulate(fanout)) + \
+            b''.join(sha for sha, crc, offset in pack_objects) + \
+            b''.join(pack('>I', crc) for sha, crc, offset in pack_objects) + \
+            b''.join(pack('>I', 0x80000000 | large_offsets_indexes[offset] if offset >= 0x80000000 else offset) for sha, crc, offset in pack_objects) + \
+            b''.join(pack('>Q', offset) for offset in large_offsets) + \
+            pack_sha
+        return index + sha1(index).digest()
+
+    def upload_pack_index_and_listing(storage, target_prefix, temp_key, pack_objects, pack_sha):
+        pack_name = f'pack-{pack_sha.hex()}'
+        storage.copy(temp_key, f'{target_prefix}/objects/pack/{pack_name}.pack')
+        storage.delete((temp_key,))
+        storage.put(f'{target_prefix}/objects/pack/{pack_name}.idx', get_pack_index(pack_objects, pack_sha))
+
+        # In incremental mode the packs of previous runs are still needed
+        try:
+            existing_packs = storage.get(f'{target_prefix}/objects/info/packs').splitlines() if incremental else []
+        except KeyError:
+            existing_packs = []
+        packs = list(dict.fromkeys(
+            line
+            for line in existing_packs + [f'P {pack_name}.pack'.encode()]
+            if line.startswith(b'P ')
+        ))
+        storage.put(f'{target_prefix}/objects/info/packs', b''.join(line + b'\n' for line in packs) + b'\n')
+
+        # Packs of previous runs that are no longer listed, which are all of them if not in
+        # incremental mode, are never read again
+        listed_pack_names = {line[2:].decode().removesuffix('.pack') for line in packs}
+        storage.delete(
+            key
+            for key in storage.list(f'{target_prefix}/objects/pack/')
+            if (match := re.fullmatch(r'.*/(pack-[0-9a-f]{40})\.(pack|idx)', key)) and match[1] not in listed_pack_names
+        )
+
+    def worker_func(q, exceptions):
         while item := q.get():
             try:
                 if item is done:
@@ -438,24 +2227,460 @@ def mirror_repos(mappings,
                 item()
             except Exception as e:
                 logger.exception('Exception in thread')
+                exceptions.append(e)
             finally:
                 q.task_done()
 
-    def mirror_repo(s3_client, http_client, source_base_url, target):
+    def get_object_index(storage, storage_key, objects_prefix, repo):
+        # Repos mirrored to the same objects prefix in the same run, which they are if it's shared,
+        # share an index, so an object uploaded for one isn't uploaded again for another
+        with object_indexes_lock:
+            lock, indexes = object_indexes.setdefault((storage_key, objects_prefix), (Lock(), []))
+        with lock:
+            if not indexes:
+                indexes.append(load_object_index(storage, objects_prefix, repo))
+            return indexes[0]
+
+    def load_object_index(storage, objects_prefix, repo):
+        # The SHAs of the loose objects in the objects prefix, sorted and concatenated, so objects
+        # already there aren't uploaded again. It's stored as a single object, and if that's missing
+        # it's rebuilt by listing each of the 256 object directories concurrently. Objects uploaded
+        # during the run are also treated as existing once they're stored, and are added to the
+        # stored index at the end of each repo
+        key = f'{objects_prefix}/info/mirror-git-to-s3-index'
+        uploaded_shas = ShaIndex()
+        uploaded_shas_lock = Lock()
+
+        def list_shas(sha_prefix_hex):
+            prefix = f'{objects_prefix}/{sha_prefix_hex}/'
+            return [
+                bytes.fromhex(sha_prefix_hex + object_key[len(prefix):])
+                for object_key in storage.list(prefix)
+                if re.fullmatch('[0-9a-f]{38}', object_key[len(prefix):])
+            ]
+
+        try:
+            existing_shas = storage.get(key)
+            is_stored = True
+        except KeyError:
+            logger.info('Listing objects to build index')
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=object_index_lists_in_flight) as executor:
+                existing_shas = b''.join(sorted(itertools.chain.from_iterable(
+                    executor.map(list_shas, (f'{i:02x}' for i in range(0, 256)))
+                )))
+            inc('object_index_build_seconds_total', time.perf_counter() - start, repo=repo)
+            is_stored = False
+        set_gauge('object_index_objects', len(existing_shas) // 20, repo=repo)
+
+        def is_existing_object(sha):
+            with uploaded_shas_lock:
+                is_uploaded = sha in uploaded_shas
+            return is_uploaded or sorted_shas_contain(existing_shas, sha)
+
+        def add_uploaded_object(sha):
+            with uploaded_shas_lock:
+                uploaded_shas.add(sha)
+
+        def save_object_index(storage):
+            with uploaded_shas_lock:
+                sorted_uploaded_shas = sorted(uploaded_shas)
+            if is_stored and not sorted_uploaded_shas:
+                return
+            storage.put(key, b''.join(heapq.merge(
+                (existing_shas[i:i + 20] for i in range(0, len(existing_shas), 20)),
+                sorted_uploaded_shas,
+            )))
+
+        return is_existing_object, add_uploaded_object, save_object_index
+
+    def get_object_processor(executor):
+        # Sending an object to another process costs more than processing a small object, so
+        # they're sent in batches. A batch is sent once it's full, or once an object in it has
+        # waited for object_process_batch_wait
+        lock = Lock()
+        batch = []
+
+        def take_batch():
+            nonlocal batch
+            taken, batch = batch, []
+            return taken
+
+        def send(to_send):
+            def on_done(future):
+                try:
+                    values = future.result()
+                except Exception as e:
+                    for _, result in to_send:
+                        result.set_exception(e)
+                else:
+                    for (_, result), value in zip(to_send, values):
+                        result.set_result(value)
+
+            inc('object_process_batches_total', 1)
+            executor.submit(hash_and_compress_objects, [args for args, _ in to_send]).add_done_callback(on_done)
+
+        def process_object(type_name, object_bytes, should_compress):
+            start = time.perf_counter()
+            result = Future()
+            with lock:
+                batch.append(((type_name, object_bytes, should_compress), result))
+                to_send = take_batch() if len(batch) >= object_process_batch_size else []
+            if to_send:
+                send(to_send)
+            try:
+                return result.result(timeout=object_process_batch_wait)
+            except FutureTimeoutError:
+                with lock:
+                    to_send = take_batch() if any(queued is result for _, queued in batch) else []
+                if to_send:
+                    send(to_send)
+                return result.result()
+            finally:
+                inc('object_process_seconds_total', time.perf_counter() - start)
+
+        return process_object
+
+    def call_and_release_bytes(func, release_bytes, num_bytes):
+        # If func returns a Future, the bytes are released once it's done
+        try:
+            result = func()
+        except BaseException:
+            release_bytes(num_bytes)
+            raise
+        if isinstance(result, Future):
+            result.add_done_callback(lambda _: release_bytes(num_bytes))
+        else:
+            release_bytes(num_bytes)
+        return result
+
+    def call_and_drain(func, chunks):
+        # If func fails before it's consumed all the chunks, the rest are consumed and discarded
+        # so whatever is producing them doesn't block
+        try:
+            return func()
+        except BaseException:
+            for _ in chunks:
+                pass
+            raise
+
+    def get_scheduler(objects, repo):
+        # Runs the jobs for the objects of a pack on worker threads. A delta's job is only run once
+        # its base has been uploaded, so it never occupies a worker while waiting. Jobs that read
+        # bytes from the parser are run first since the parser is blocked until they are, and then
+        # objects ordered by how many deltas are waiting on them, and then in the order parsed.
+        # Deltas can start waiting on an object after it's queued, in which case it's queued again
+        # with the higher priority and its earlier entry skipped. Each object is added to the
+        # registry as it's submitted, which is in the order parsed
+        condition = Condition()
+        stream_jobs = deque()
+        ready_jobs = []
+        ready_entries = {}
+        job_order = itertools.count()
+        pending_deltas = defaultdict(list)
+        num_pending = 0
+        claimed_bases = set()
+        deferred_deltas = []
+        deferring_finished = False
+        num_running = 0
+        submitting_finished = False
+
+        def _get_num_waiting(pack_offset):
+            # Deltas wait on an object by its offset, or by its SHA if it's known. A ref delta only
+            # has the SHA of its base, and which object in the pack has that SHA isn't known until
+            # it's uploaded, so ref deltas only count toward their base's priority from then. Since
+            # ofs-delta is requested, deltas against objects in the pack are almost always ofs
+            # deltas, and ref deltas are against bases from previous runs
+            sha = objects.get_sha_at_offset(pack_offset)
+            return len(pending_deltas.get(('offset', pack_offset), ())) + (len(pending_deltas.get(('sha', sha), ())) if sha is not None else 0)
+
+        def _push_ready(pack_offset, job_order, job):
+            entry = (-_get_num_waiting(pack_offset), job_order, pack_offset, job)
+            ready_entries[pack_offset] = entry
+            heapq.heappush(ready_jobs, entry)
+
+        def _pop_ready():
+            while True:
+                entry = heapq.heappop(ready_jobs)
+                _, _, pack_offset, job = entry
+                if ready_entries.get(pack_offset) is entry:
+                    del ready_entries[pack_offset]
+                    return pack_offset, job
+
+        def _make_ready(pack_offset, job):
+            trace_begin('queued', f'{repo} {pack_offset}')
+            _push_ready(pack_offset, next(job_order), job)
+            condition.notify_all()
+
+        def _reprioritise(base_key):
+            base_type, base = base_key
+            pack_offset = base if base_type == 'offset' else objects.get_offset(base)
+            entry = ready_entries.get(pack_offset)
+            if entry is not None:
+                _, order, _, job = entry
+                _push_ready(pack_offset, order, job)
+
+        def submit_stream_job(pack_offset, job):
+            with condition:
+                objects.add_offset(pack_offset)
+                condition.wait_for(lambda: not stream_jobs)
+                trace_begin('queued', f'{repo} {pack_offset}')
+                stream_jobs.append((pack_offset, job))
+                condition.notify_all()
+
+        def submit_job(pack_offset, job):
+            with condition:
+                objects.add_offset(pack_offset)
+                _make_ready(pack_offset, job)
+                set_gauge('queue_depth', len(ready_entries), repo=repo, queue='ready')
+
+        def add_delta(pack_offset, base_key, job):
+            # The base key is ('offset', <offset of base in pack>) or ('sha', <SHA of base>), and
+            # the job is called with the SHA of the base
+            nonlocal num_pending
+            with condition:
+                base_type, base = base_key
+                base_sha = \
+                    objects.get_sha_at_offset(base) if base_type == 'offset' else \
+                    base if base in objects else \
+                    None
+                if base_sha is not None:
+                    _make_ready(pack_offset, partial(job, base_sha))
+                else:
+                    trace_begin('waiting for base', f'{repo} {pack_offset}', base=base if base_type == 'offset' else base.hex())
+                    pending_deltas[base_key].append((pack_offset, job))
+                    _reprioritise(base_key)
+                    num_pending += 1
+                    set_gauge('pending_deltas', num_pending, repo=repo)
+
+        def complete(pack_offset, sha, object_type):
+            # Objects from a previous run don't have an offset in the pack
+            nonlocal num_pending
+            with condition:
+                objects.complete(pack_offset, sha, object_type)
+                if pack_offset is not None:
+                    trace_end('object', f'{repo} {pack_offset}', sha=sha.hex(), type=types_names_for_hash[object_type].decode())
+                released = pending_deltas.pop(('offset', pack_offset), []) + pending_deltas.pop(('sha', sha), [])
+                for delta_pack_offset, job in released:
+                    trace_end('waiting for base', f'{repo} {delta_pack_offset}')
+                    _make_ready(delta_pack_offset, partial(job, sha))
+                num_pending -= len(released)
+
+        def defer_delta(pack_offset, job):
+            # Until release_deferred_deltas is called, returning whether it's deferred
+            with condition:
+                if not deferring_finished:
+                    trace_begin('waiting for pack', f'{repo} {pack_offset}')
+                    deferred_deltas.append((pack_offset, job))
+                return not deferring_finished
+
+        def release_deferred_deltas():
+            nonlocal deferring_finished
+            with condition:
+                deferring_finished = True
+                for pack_offset, job in deferred_deltas:
+                    trace_end('waiting for pack', f'{repo} {pack_offset}')
+                    _make_ready(pack_offset, job)
+                deferred_deltas.clear()
+
+        def get_pack_entry(base_key):
+            # The offset of an object in the pack by ('offset', <offset>) or ('sha', <SHA>), the
+            # offset of the object after it or None if it's the last, and its SHA
+            with condition:
+                base_type, base = base_key
+                pack_offset = base if base_type == 'offset' else objects.get_offset(base)
+                return pack_offset, objects.get_next_offset(pack_offset), objects.get_sha_at_offset(pack_offset)
+
+        def claim_base(sha):
+            # Whether this is the first attempt to find a base that's not yet been uploaded
+            with condition:
+                to_claim = sha not in objects and sha not in claimed_bases
+                if to_claim:
+                    claimed_bases.add(sha)
+                return to_claim
+
+        def get_object_type(sha):
+            with condition:
+                return objects.get_type(sha)
+
+        def run_worker(exceptions):
+            nonlocal num_running
+            while True:
+                with condition:
+                    condition.wait_for(lambda: stream_jobs or ready_entries or (submitting_finished and not num_running))
+                    if stream_jobs:
+                        pack_offset, job = stream_jobs.popleft()
+                    elif ready_entries:
+                        pack_offset, job = _pop_ready()
+                    else:
+                        break
+                    num_running += 1
+                    set_gauge('queue_depth', len(ready_entries), repo=repo, queue='ready')
+                    condition.notify_all()
+                trace_end('queued', f'{repo} {pack_offset}')
+                try:
+                    with trace_span('job', repo=repo, offset=pack_offset):
+                        result = job()
+                except Exception as e:
+                    logger.exception('Exception in thread')
+                    exceptions.append(e)
+                    finish_job(None)
+                else:
+                    if isinstance(result, Future):
+                        result.add_done_callback(partial(finish_job, exceptions=exceptions))
+                    else:
+                        finish_job(None)
+
+        def finish_job(future, exceptions=None):
+            # A job that returns a Future is running until the Future is done, even though its
+            # worker has moved on
+            nonlocal num_running
+            if future is not None and future.exception() is not None:
+                logger.error('Exception in thread', exc_info=future.exception())
+                exceptions.append(future.exception())
+            with condition:
+                num_running -= 1
+                condition.notify_all()
+
+        def finish_submitting():
+            nonlocal submitting_finished
+            with condition:
+                submitting_finished = True
+                condition.notify_all()
+
+        def get_missing_bases():
+            # Once the workers have finished, any deltas still pending have bases that are neither
+            # in the pack nor the target, or that depend on each other
+            with condition:
+                return [
+                    f'offset {base}' if base_type == 'offset' else base.hex()
+                    for base_type, base in pending_deltas.keys()
+                ]
+
+        return submit_stream_job, submit_job, add_delta, defer_delta, release_deferred_deltas, get_pack_entry, complete, claim_base, get_object_type, run_worker, finish_submitting, get_missing_bases
+
+    def get_bytes_semaphore(max_bytes):
+        # Limits the total of a quantity across threads, but anything larger than the limit is
+        # allowed through on its own so nothing waits forever
+        condition = Condition()
+        available = max_bytes
+
+        def acquire_bytes(num_bytes):
+            # Returns the amount to release, which can be in a different thread
+            nonlocal available
+            num_bytes = min(num_bytes, max_bytes)
+            with condition:
+                condition.wait_for(lambda: available >= num_bytes)
+                available -= num_bytes
+            return num_bytes
+
+        def release_bytes(num_bytes):
+            nonlocal available
+            with condition:
+                available += num_bytes
+                condition.notify_all()
+
+        @contextmanager
+        def acquire(num_bytes):
+            num_bytes = acquire_bytes(num_bytes)
+            try:
+                yield
+            finally:
+                release_bytes(num_bytes)
+
+        return acquire, acquire_bytes, release_bytes
+
+    @contextmanager
+    def limit_requests_in_flight(s3_client, semaphore):
+        # Each HTTP request that the client makes, including each part of a multipart upload,
+        # holds a slot from when it's sent to when its response headers are received. The client
+        # can be the caller's, so the handlers are unregistered once finished
+        def acquire(**kwargs):
+            semaphore.acquire()
+
+        def release(**kwargs):
+            semaphore.release()
+
+        s3_client.meta.events.register('before-send.s3', acquire)
+        s3_client.meta.events.register('response-received.s3', release)
+        try:
+            yield
+        finally:
+            s3_client.meta.events.unregister('before-send.s3', acquire)
+            s3_client.meta.events.unregister('response-received.s3', release)
+
+    def get_storage_for_target(parsed_target):
+        # Repos in the same bucket or filesystem share a storage
+        key = (parsed_target.scheme, parsed_target.netloc)
+        with storages_lock:
+            if key not in storages:
+                storages[key] = \
+                    get_storage(*key) if get_storage is not None else \
+                    get_default_storage(s3_client, *key, s3_storage_class, async_s3_requests_in_flight, s3_requests_in_flight)
+            storage = storages[key]
+        if storage is None:
+            raise ValueError(f'Unsupported target {parsed_target.geturl()}')
+        return storage
+
+    def mirror_repo(http_client, source_base_url, target, bar_position):
         # Process objects and LFS files in separate threads so (when possible) to minimise blocking
-        object_queue = Queue(maxsize=1)
-        object_workers = [Thread(target=worker_func, args=(object_queue,)) for _ in range(0, num_object_workers)]
+        worker_exceptions = []
+
+        # The offset, SHA and type of each object in the pack, used to resolve OBJ_OFS_DELTA bases
+        # and to construct the index in pack mode
+        objects = ObjectRegistry()
+        submit_object_stream_job, submit_object_job, add_delta, defer_delta, release_deferred_deltas, get_pack_entry, complete, claim_base, get_object_type, run_object_worker, finish_object_jobs, get_missing_bases = get_scheduler(objects, source_base_url)
+        object_workers = [Thread(target=run_object_worker, args=(worker_exceptions,)) for _ in range(0, num_object_workers)]
         for worker in object_workers:
             worker.start()
 
+        # LFS pointers are batched before being given to the LFS workers. The download URLs
+        # can expire, so only a couple of batches are resolved ahead of the workers
         lfs_queue = Queue(maxsize=lfs_queue_size)
-        lfs_workers = [Thread(target=worker_func, args=(lfs_queue,)) for _ in range(0, num_lfs_workers)]
+        lfs_download_queue = Queue(maxsize=lfs_batch_size)
+        lfs_batcher = None
+        lfs_workers = [Thread(target=worker_func, args=(lfs_download_queue, worker_exceptions)) for _ in range(0, num_lfs_workers)]
         for worker in lfs_workers:
             worker.start()
 
-        sha_lock = Lock()
-        sha_events = defaultdict(Event)
-        shas = {}
+        # The SHA-1 of the pack as it's received, to check against its trailer. In pack mode the
+        # pack is also uploaded as it's received, and the CRC32 of each object in it recorded to
+        # construct the index
+        pack_sha = sha1()
+        pack_crcs = array('I')
+        pack_crc = 0
+        pack_start = None
+        pack_bytes_before_start = []
+        pack_queue = Queue(maxsize=16)
+        pack_thread = None
+        pack_temp_key = None
+        pack_end = None
+        pack_exceptions = []
+
+        def finish_uploading_pack():
+            nonlocal pack_thread
+            if pack_thread is not None:
+                pack_queue.put(done)
+                pack_thread.join()
+                pack_thread = None
+                worker_exceptions.extend(pack_exceptions)
+
+        def get_pack_object(base_key):
+            # Once the pack is stored, deltas read bases that are no longer cached from it
+            return get_object_from_pack(storage, source_base_url, target_prefix, pack_temp_key, pack_end, get_pack_entry, base_key)
+
+        # The queue of the object being streamed to a worker, until all its bytes are on it
+        object_bytes_queue = None
+
+        def on_pack_bytes(pack_bytes):
+            nonlocal pack_crc
+            if pack_start is None:
+                pack_bytes_before_start.append(pack_bytes)
+                return
+            pack_sha.update(pack_bytes)
+            if storage_format == 'pack':
+                pack_crc = zlib.crc32(pack_bytes, pack_crc)
+                pack_queue.put(pack_bytes)
 
         # tqdm by default shows total=0 as 0% done, but we want to only treat total=None as 0%,
         # to only invoke the total=0 case when we know there are no lfs pointers
@@ -480,70 +2705,233 @@ def mirror_repos(mappings,
                 ((' ' * (width - len(desc))) + desc) if len(desc) < width else \
                 ('... ' + desc[max(len(desc) - width + 4, 0):])
 
-        object_bar = TqdmZeroDone(total=None, desc=format_desc(source_base_url + ' [obj]'), unit='obj', position=0)
-        lfs_bar = TqdmZeroDone(total=None, desc=format_desc(source_base_url + ' [lfs]'), unit='B', position=1, unit_scale=True)
+        object_bar = TqdmZeroDone(total=None, desc=format_desc(source_base_url + ' [obj]'), unit='obj', position=bar_position)
+        lfs_bar = TqdmZeroDone(total=None, desc=format_desc(source_base_url + ' [lfs]'), unit='B', position=bar_position + 1, unit_scale=True)
         lfs_bar_lock = Lock()
 
         try:
             parsed_target = urllib.parse.urlparse(target)
-            assert parsed_target.scheme == 's3'
-            bucket = parsed_target.netloc
+            storage = get_storage_for_target(parsed_target)
+            if metrics is not None:
+                storage = MeasuredStorage(storage, metrics, {'repo': source_base_url})
+            if trace is not None:
+                storage = TracedStorage(storage, trace, {'repo': source_base_url})
+            storage = AdaptiveStorage(storage, (
+                (adaptive_requests_in_flight_all_repos, AdaptiveLimit(adaptive_requests_in_flight))
+                if adaptive_requests_in_flight is not None else
+                ()
+            ), storage_attempts, metrics, {'repo': source_base_url})
             target_prefix = parsed_target.path[1:] # Remove leading /
-            clear_tmp(s3_client, bucket, target_prefix)
-
-            head_ref, refs = get_refs(http_client, source_base_url)
-
-            pack_file_request = b''.join(
-                b'0032want ' + sha[4:] + b'\n'
+            clear_tmp(storage, target_prefix)
+
+            # Loose objects can be stored under a prefix shared by all targets in the bucket, which
+            # clients find through the alternates files in each target
+            objects_prefix = \
+                f'{target_prefix}/objects' if shared_objects_prefix is None else \
+                shared_objects_prefix.strip('/')
+
+            # Packs are stored as received, so only loose objects can be skipped
+            is_existing_object, add_uploaded_object, save_object_index = \
+                get_object_index(storage, (parsed_target.scheme, parsed_target.netloc), objects_prefix, source_base_url) if storage_format == 'loose' else \
+                (lambda sha: False, lambda sha: None, lambda storage: None)
+
+            lfs_batcher = Thread(target=batch_lfs_pointers, args=(storage, http_client, target_prefix, source_base_url, lfs_bar, lfs_queue, lfs_download_queue, worker_exceptions))
+            lfs_batcher.start()
+
+            protocol_version, head_ref, capabilities, refs = get_refs(http_client, source_base_url)
+
+            # In incremental mode we tell the server which commits we already have, so it only
+            # sends objects that are new
+            haves = list(dict.fromkeys(
+                sha
+                for sha, ref in get_existing_refs(storage, target_prefix)
+            )) if incremental else []
+
+            # Refs of other targets that share the objects prefix are also sent as haves, so for a
+            # fork of a repo that's already mirrored, only what's new in the fork is fetched
+            if shared_objects_prefix is not None:
+                haves = list(dict.fromkeys(haves + get_shared_haves(storage, objects_prefix)))
+
+            # If the pack is thin, deltas can be against objects in the target that aren't in it
+            thin_claim_base = \
+                claim_base if haves and storage_format == 'loose' else \
+                lambda sha: False
+            # The objects that peeled tags point to are sent with the tags
+            wants = list(dict.fromkeys(
+                sha
                 for sha, ref in refs
-            ) + b'0000' + b'0009done\n'
-
-            with http_client.stream('POST', f'{source_base_url}/git-upload-pack', content=pack_file_request) as response:
-                response.raise_for_status()
-
-                yield_indefinite, read_bytes, return_unused = get_reader(smooth(response.iter_bytes(16384)))
-
-                length = int(read_bytes(4), 16)
-                chunk = read_bytes(length - 4)
-                assert chunk == b'NAK\n'
-
-                signature = read_bytes(4)
-                assert signature == b'PACK'
-                version, = unpack('>I', read_bytes(4))
-                assert version == 2
-
-                number_of_objects, = unpack('>I', read_bytes(4))
-
-                for i in range(0, number_of_objects):
-                    object_bar.total = number_of_objects
-
-                    object_type, object_length = get_object_type_and_length(read_bytes)
-                    assert object_type in (1, 2, 3, 4, 7)  # 6 == OBJ_OFS_DELTA is unsupported for now
-
-                    uncompressed = yield_with_asserted_length(uncompress_zlib(yield_indefinite, return_unused), object_length)
-                    object_bytes_queue = Queue(maxsize=1)
-
-                    object_queue.put(
-                        partial(upload_object, http_client, bucket, source_base_url, target_prefix, object_type, object_length, sha_lock, sha_events, shas, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, object_bytes=queue_to_iterable(object_bytes_queue,)) if object_type in (1, 2, 3, 4) else \
-                        partial(construct_object_from_delta_and_upload, s3_client, bucket, source_base_url, target_prefix, sha_lock, sha_events, shas, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, base_sha=read_bytes(20), delta_bytes=queue_to_iterable(object_bytes_queue,))
-                    )
-                    for chunk in uncompressed:
-                        object_bytes_queue.put(chunk)
-                    object_bytes_queue.put(done)
+                if sha not in haves and not ref.endswith(b'^{}')
+            ))
 
-                trailer = read_bytes(20)
+            # A filter leaves out blobs larger than the limit, if the server supports it
+            supports_filter = \
+                b'filter' in capabilities if protocol_version == 0 else \
+                any(capability.startswith(b'fetch=') and b'filter' in capability[6:].split() for capability in capabilities)
+            if blob_size_limit is not None and not supports_filter:
+                logger.warning('Filters are not supported by %s, so all blobs are fetched', source_base_url)
+            filter_line = pkt_line(b'filter blob:limit=%d\n' % blob_size_limit) if blob_size_limit is not None and supports_filter else b''
+
+            # Thin packs can't be stored as-is, since the objects they depend on are not in them.
+            # Protocol v2 sends the same options as arguments to the fetch command
+            request_capabilities = [
+                capability
+                for capability, should_request in (
+                    (b'ofs-delta', True),
+                    (b'thin-pack', haves and storage_format == 'loose'),
+                    (b'filter', filter_line),
+                )
+                if should_request and (capability in capabilities or protocol_version == 2)
+            ]
+            wants_and_haves = b''.join(
+                pkt_line(b'want ' + sha + (b''.join(b' ' + capability for capability in request_capabilities) if i == 0 and protocol_version == 0 else b'') + b'\n')
+                for i, sha in enumerate(wants)
+            ) + filter_line + (b'0000' if protocol_version == 0 else b'') + b''.join(
+                pkt_line(b'have ' + sha + b'\n')
+                for sha in haves
+            ) + pkt_line(b'done\n')
+
+            pack_file_request = wants_and_haves if protocol_version == 0 else \
+                pkt_line(b'command=fetch\n') + b'0001' + pkt_line(b'no-progress\n') + b''.join(
+                    pkt_line(capability + b'\n')
+                    for capability in request_capabilities
+                    if capability != b'filter'
+                ) + wants_and_haves + b'0000'
+
+            if not wants:
+                logger.info('No new commits to fetch')
+                object_bar.total = 0
+            else:
+                with http_connections, http_client.stream('POST', f'{source_base_url}/git-upload-pack', content=pack_file_request, headers={
+                    'Content-Type': 'application/x-git-upload-pack-request',
+                    **({'Git-Protocol': 'version=2'} if protocol_version == 2 else {}),
+                }) as response:
+                    response.raise_for_status()
+
+                    response_bytes = smooth(response.iter_bytes(16384), source_base_url)
+                    if protocol_version == 2:
+                        response_bytes = demultiplex_pack(response_bytes)
+                    yield_indefinite, read_bytes, read_byte, return_unused, get_offset = get_reader(response_bytes, on_consumed=on_pack_bytes)
+
+                    # Without multi_ack, there is a single NAK, or ACK if we sent haves in common.
+                    # In protocol v2 the pack starts straight away
+                    while True:
+                        get_offset()
+                        pack_bytes_before_start.clear()
+                        if (signature := read_bytes(4)) == b'PACK':
+                            break
+                        chunk = read_bytes(int(signature, 16) - 4)
+                        assert chunk == b'NAK\n' or chunk.startswith(b'ACK ')
+
+                    pack_start = get_offset() - 4
+                    if storage_format == 'pack':
+                        pack_temp_key = f'{target_prefix}/mirror_tmp/{str(uuid.uuid4())}'
+                        pack_thread = Thread(target=upload_pack, args=(storage, pack_temp_key, queue_to_iterable(pack_queue), pack_exceptions))
+                        pack_thread.start()
+                    for pack_bytes in pack_bytes_before_start:
+                        on_pack_bytes(pack_bytes)
+
+                    version, = unpack('>I', read_bytes(4))
+                    assert version == 2
+
+                    number_of_objects, = unpack('>I', read_bytes(4))
+
+                    for i in range(0, number_of_objects):
+                        object_bar.total = number_of_objects
+                        parse_start = trace.now() if trace is not None else None
+
+                        pack_offset = get_offset() - pack_start
+                        if i:
+                            pack_crcs.append(pack_crc)
+                        pack_crc = 0
+
+                        object_type, object_length = get_object_type_and_length(read_byte)
+                        assert object_type in (1, 2, 3, 4, 6, 7)
+                        trace_begin('object', f'{source_base_url} {pack_offset}', offset=pack_offset, type=pack_types_names[object_type], size=object_length)
+
+                        base_pack_offset = pack_offset - get_negative_offset(read_byte) if object_type == 6 else None
+                        base_sha = read_bytes(20) if object_type == 7 else None
+                        uncompressed = yield_with_asserted_length(uncompress_zlib(yield_indefinite, return_unused, source_base_url), object_length)
+
+                        # Small objects are decompressed whole so the parser can move on to the
+                        # next without waiting for a worker, up to the budget of bytes in flight.
+                        # Larger objects are streamed to a worker as they're decompressed
+                        is_small = object_length < materialise_max_size
+                        put_start = time.perf_counter()
+                        if is_small:
+                            with trace_span('wait for object bytes', repo=source_base_url):
+                                num_bytes = acquire_object_bytes(object_length)
+                            object_bytes_queue = None
+                            try:
+                                object_bytes = tuple(uncompressed)
+                            except Exception:
+                                release_object_bytes(num_bytes)
+                                raise
+                        else:
+                            # If the pack is cut off, the worker gets fewer bytes than expected
+                            object_bytes_queue = Queue(maxsize=16)
+                            queued_object_bytes = queue_to_iterable(object_bytes_queue)
+                            object_bytes = yield_with_asserted_length(queued_object_bytes, object_length)
+
+                        job = \
+                            partial(upload_object, http_client, storage, source_base_url, target_prefix, objects_prefix, is_existing_object, add_uploaded_object, object_type, object_length, complete, pack_offset, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, object_bytes=object_bytes) if object_type in (1, 2, 3, 4) else \
+                            partial(construct_object_from_delta_and_upload, storage, source_base_url, target_prefix, objects_prefix, is_existing_object, add_uploaded_object, add_delta, defer_delta, get_pack_object, complete, thin_claim_base, get_object_type, pack_offset, object_bar, lfs_bar, lfs_bar_lock, lfs_queue, base_sha=base_sha, base_pack_offset=base_pack_offset, delta_bytes=object_bytes)
+                        if is_small:
+                            # A delta's bytes are released once it's decoded, rather than once
+                            # it's uploaded, since its base may be later in the pack
+                            submit_object_job(pack_offset, partial(call_and_release_bytes, job, release_object_bytes, num_bytes))
+                        else:
+                            with trace_span('wait for workers', repo=source_base_url):
+                                submit_object_stream_job(pack_offset, partial(call_and_drain, job, queued_object_bytes))
+
+                        # Time waiting here is time that all the object workers are busy, or
+                        # that the budget of bytes in flight is used up
+                        inc('object_queue_put_wait_seconds_total', time.perf_counter() - put_start, repo=source_base_url)
+
+                        if object_bytes_queue is not None:
+                            for chunk in uncompressed:
+                                object_bytes_queue.put(chunk)
+                            object_bytes_queue.put(done)
+                            object_bytes_queue = None
+
+                        if trace is not None:
+                            trace.add('parse', parse_start, repo=source_base_url, offset=pack_offset, type=pack_types_names[object_type], size=object_length)
+
+                    pack_end = get_offset() - pack_start
+                    if number_of_objects:
+                        pack_crcs.append(pack_crc)
+
+                    # The trailer is the SHA-1 of everything before it in the pack
+                    expected_trailer = pack_sha.digest()
+                    trailer = read_bytes(20)
+                    get_offset()
+                    if trailer != expected_trailer:
+                        raise Exception(f'Pack checksum {expected_trailer.hex()} does not match its trailer {trailer.hex()}')
+
+                    finish_uploading_pack()
+                    if not pack_exceptions:
+                        release_deferred_deltas()
         finally:
+            # If the pack is cut off part way through an object, the worker streaming it would
+            # otherwise wait for the rest of it forever
+            if object_bytes_queue is not None:
+                object_bytes_queue.put(done)
+
             logger.info('Waiting for regular objects to be uploaded')
-            for i in range(0, num_object_workers):
-                object_queue.put(done)
+            finish_object_jobs()
             for worker in object_workers:
                 worker.join()
 
+            finish_uploading_pack()
+
             # Ensure all LFS workers have finished
             logger.info('Regular objects uploaded. Waiting for LFS objects to be copied')
 
-            for i in range(0, num_lfs_workers):
+            if lfs_batcher is not None:
                 lfs_queue.put(done)
+                lfs_batcher.join()
+            else:
+                for i in range(0, num_lfs_workers):
+                    lfs_download_queue.put(done)
             for worker in lfs_workers:
                 worker.join()
             logger.info('LFS objects uploaded')
@@ -554,46 +2942,748 @@ def mirror_repos(mappings,
             object_bar.close()
             lfs_bar.close()
 
-        s3_client.put_object(Bucket=bucket, Key=f'{target_prefix}/HEAD', Body=b'ref: ' + head_ref, StorageClass=s3_storage_class)
-        s3_client.put_object(Bucket=bucket, Key=f'{target_prefix}/info/refs', Body=b''.join(sha[4:] + b'\t' + ref + b'\n' for sha, ref in refs), StorageClass=s3_storage_class)
+        # Only update the refs if all their objects are in place, so clients never see refs to
+        # missing objects, and so the next incremental run can rely on them
+        if worker_exceptions:
+            raise worker_exceptions[0]
+
+        if missing_bases := get_missing_bases():
+            raise Exception('Delta bases are not in the pack or the target, or depend on each other: ' + ', '.join(missing_bases[:10]))
+
+        if pack_temp_key is not None:
+            upload_pack_index_and_listing(storage, target_prefix, pack_temp_key, (
+                (sha, pack_crc, pack_offset)
+                for (sha, pack_offset), pack_crc in zip(objects.yield_shas_and_offsets(), pack_crcs)
+            ), trailer)
+
+        save_object_index(storage)
+
+        if shared_objects_prefix is not None:
+            alternate = posixpath.relpath(objects_prefix, f'{target_prefix}/objects').encode() + b'\n'
+            storage.put(f'{target_prefix}/objects/info/http-alternates', alternate)
+            storage.put(f'{target_prefix}/objects/info/alternates', alternate)
+            # If blobs were filtered out, not everything reachable from the refs is stored
+            if blob_size_limit is None:
+                add_shared_haves(storage, objects_prefix, [sha for sha, ref in refs])
+
+        storage.put(f'{target_prefix}/HEAD', b'ref: ' + head_ref)
+        storage.put(f'{target_prefix}/info/refs', b''.join(sha + b'\t' + ref + b'\n' for sha, ref in refs))
  
-        clear_tmp(s3_client, bucket, target_prefix)
+        clear_tmp(storage, target_prefix)
+
+    def get_refs_digest(head_ref, refs):
+        # So the refs of thousands of repos can be compared without keeping them all in memory
+        return sha1(b''.join([b'ref: ' + (head_ref or b'') + b'\n'] + sorted(
+            sha + b'\t' + ref + b'\n'
+            for sha, ref in refs
+        ))).digest()
+
+    def get_target_refs_digest(target):
+        parsed_target = urllib.parse.urlparse(target)
+        storage = get_storage_for_target(parsed_target)
+        target_prefix = parsed_target.path[1:]
+        refs = get_existing_refs(storage, target_prefix)
+        try:
+            head_ref = storage.get(f'{target_prefix}/HEAD').removeprefix(b'ref: ')
+        except KeyError:
+            head_ref = None
+        return get_refs_digest(head_ref, refs), bool(refs)
+
+    def get_advertised_refs_digest(http_client, base_url, state):
+        # A single request for the protocol v0 advertisement of all the refs, conditional on the
+        # previous response if the server supports it. None if the refs haven't changed since
+        headers = {
+            name: state[key]
+            for name, key in (('If-None-Match', 'etag'), ('If-Modified-Since', 'last_modified'))
+            if state[key] is not None
+        }
+        with http_connections:
+            r = http_client.get(f'{base_url}/info/refs?service=git-upload-pack', headers=headers)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        state['etag'] = r.headers.get('etag')
+        state['last_modified'] = r.headers.get('last-modified')
+
+        lines = yield_pkt_lines((r.content,))
+        line = next(lines)
+        if line.startswith(b'# service='):
+            next(lines)
+            line = next(lines)
+        head_ref = None
+        refs = []
+        while line is not None:
+            line, _, capabilities = line.rstrip(b'\n').partition(b'\x00')
+            if capabilities:
+                head_ref_match = re.match(b'.*symref=HEAD:(\\S+).*', capabilities)
+                head_ref = head_ref_match.group(1) if head_ref_match else None
+            sha, ref = line.split(b' ')
+            if ref != b'HEAD' and ref != b'capabilities^{}' and is_ref_included(ref):
+                refs.append((sha, ref))
+            line = next(lines)
+        return get_refs_digest(head_ref, refs)
+
+    def start_polling(http_client, mappings):
+        # Polls the refs of each source every poll_interval, and to each host at most
+        # max_polls_per_host_per_second. Returns an iterable of the mappings whose source refs
+        # differ from those in the target, which blocks until there is one, a function to call
+        # once each is mirrored, and a function to wait for polling to stop. The refs in each
+        # target are only fetched before it's first polled and after each time it's mirrored
+        stop = stop_polling if stop_polling is not None else Event()
+        condition = Condition()
+        mappings = list(dict.fromkeys((source_base_url, target) for source_base_url, target in mappings))
+        indexes = {mapping: i for i, mapping in enumerate(mappings)}
+        states = [
+            {'etag': None, 'last_modified': None, 'source_digest': None, 'target_digest': None, 'is_mirrored': False}
+            for _ in mappings
+        ]
+
+        # Each is (time due, index, whether it's been given a time slot for its host). A repo is
+        # only in one of these at once, or being polled, or being mirrored. Changed repos that
+        # have never been mirrored go first, then the ones that have been waiting the longest
+        polls_due = [(0, i, False) for i in range(0, len(mappings))]
+        changed = []
+        hosts_next_poll = defaultdict(float)
+        polls = BoundedSemaphore(polls_in_flight)
+        poll_executor = ThreadPoolExecutor(max_workers=polls_in_flight)
+
+        def poll(i):
+            source_base_url, target = mappings[i]
+            state = states[i]
+            try:
+                if state['target_digest'] is None:
+                    state['target_digest'], state['is_mirrored'] = get_target_refs_digest(target)
+                source_digest = get_advertised_refs_digest(http_client, source_base_url, state)
+                if source_digest is not None:
+                    state['source_digest'] = source_digest
+                is_changed = state['source_digest'] != state['target_digest']
+            except Exception:
+                inc('polls_total', 1, repo=source_base_url, outcome='failed')
+                logger.exception('Failed polling %s but carrying on', source_base_url)
+                is_changed = False
+            else:
+                inc('polls_total', 1, repo=source_base_url, outcome='changed' if is_changed else 'unchanged')
+            finally:
+                polls.release()
+
+            with condition:
+                if is_changed:
+                    heapq.heappush(changed, (state['is_mirrored'], time.monotonic(), i))
+                    set_gauge('repos_changed_queued', len(changed))
+                else:
+                    heapq.heappush(polls_due, (time.monotonic() + poll_interval, i, False))
+                condition.notify_all()
+
+        def schedule_polls():
+            while True:
+                with condition:
+                    while not stop.is_set() and (not polls_due or polls_due[0][0] > time.monotonic()):
+                        condition.wait(polls_due[0][0] - time.monotonic() if polls_due else None)
+                    if stop.is_set():
+                        break
+                    _, i, has_slot = heapq.heappop(polls_due)
+
+                    # Repos are given the next free slot for their host, so each is only put
+                    # back once however many repos are on the same host
+                    if not has_slot:
+                        now = time.monotonic()
+                        host = urllib.parse.urlparse(mappings[i][0]).netloc
+                        slot = max(now, hosts_next_poll[host])
+                        hosts_next_poll[host] = slot + 1 / max_polls_per_host_per_second
+                        if slot > now:
+                            heapq.heappush(polls_due, (slot, i, True))
+                            continue
+
+                polls.acquire()
+                poll_executor.submit(poll, i)
+
+        def notify_on_stop():
+            stop.wait()
+            with condition:
+                condition.notify_all()
+
+        def yield_changed_mappings():
+            while True:
+                with condition:
+                    while not stop.is_set() and not changed:
+                        condition.wait()
+                    if stop.is_set():
+                        return
+                    _, _, i = heapq.heappop(changed)
+                    set_gauge('repos_changed_queued', len(changed))
+                yield mappings[i]
+
+        def on_mirrored(source_base_url, target):
+            i = indexes[(source_base_url, target)]
+            states[i]['target_digest'] = None
+            with condition:
+                heapq.heappush(polls_due, (time.monotonic() + poll_interval, i, False))
+                condition.notify_all()
+
+        def join():
+            scheduler.join()
+            poll_executor.shutdown()
+
+        scheduler = Thread(target=schedule_polls)
+        scheduler.start()
+        Thread(target=notify_on_stop, daemon=True).start()
+
+        return yield_changed_mappings(), on_mirrored, join
 
     done = object()
 
-    types_names_for_hash = {
-        1: b'commit',
-        2: b'tree',
-        3: b'blob',
-        4: b'tag',
-    }
+    base_object_cache_get, base_object_cache_put, base_object_cache_stats = get_lru_cache(base_object_cache_size, on_get=lambda is_hit: inc(
+        'base_object_cache_hits_total' if is_hit else 'base_object_cache_misses_total', 1,
+    ))
+    # So a single object can't evict everything else
+    base_object_cache_max_object_size = base_object_cache_size // 8
 
-    s3_client = get_s3_client()
+    # For deltas whose base is not cached, ranges of the base to fetch from storage
+    base_range_max_size = 1048576
+    base_range_max_gap = 65536
+    base_ranges_in_flight = 8
+
+    # How long to wait for more LFS pointers to fill a batch, and how many times to try each download
+    lfs_batch_wait = 0.5
+    lfs_download_attempts = 3
+
+    # LFS objects larger than a range are downloaded as concurrent ranges, each uploaded as a part
+    lfs_range_size = 8388608
+    lfs_ranges_in_flight = 8
+
+    # Concurrent requests to list the objects in a target when its index is missing
+    object_index_lists_in_flight = 8
+
+    # The most small objects sent to another process at once, and how long an object waits for
+    # others to be sent with it
+    object_process_batch_size = min(64, num_object_workers * max_concurrent_repos)
+    object_process_batch_wait = 0.002
+
+    # Concurrent requests for the refs of sources when polling
+    polls_in_flight = 16
+
+    # The most refs of targets sharing an objects prefix to send as haves
+    shared_haves_max = 1024
+
+    # Objects smaller than this are decompressed whole before being passed to a worker
+    materialise_max_size = 65536
+
+    # A repo's pack is streamed over a single connection for the whole time it's processed, and
+    # LFS files can't be fetched without a connection, so we need a connection spare
+    if max_http_connections is not None and max_http_connections <= max_concurrent_repos:
+        raise ValueError('max_http_connections must be more than max_concurrent_repos')
+
+    # Packs are stored as received, and so can't be shared
+    if shared_objects_prefix is not None and storage_format != 'loose':
+        raise ValueError("shared_objects_prefix can only be used with storage_format='loose'")
 
-    first_exception = None
+    s3_client = get_s3_client()
+    s3_requests_in_flight = \
+        BoundedSemaphore(max_s3_requests_in_flight) if max_s3_requests_in_flight is not None else \
+        None
+    storages = {}
+    storages_lock = Lock()
+    object_indexes = {}
+    object_indexes_lock = Lock()
+    http_connections = \
+        BoundedSemaphore(max_http_connections) if max_http_connections is not None else \
+        nullcontext()
+    lfs_bytes_in_flight = \
+        get_bytes_semaphore(max_lfs_bytes_in_flight)[0] if max_lfs_bytes_in_flight is not None else \
+        lambda num_bytes: nullcontext()
+    _, acquire_object_bytes, release_object_bytes = get_bytes_semaphore(max_object_bytes_in_flight)
+    # Throttling can be for the whole bucket rather than for a repo, so there's also a limit
+    # that's shared by all repos
+    adaptive_requests_in_flight_all_repos = \
+        AdaptiveLimit(adaptive_requests_in_flight * max_concurrent_repos, initial=8 * max_concurrent_repos) if adaptive_requests_in_flight is not None else \
+        None
+
+    mappings_lock = Lock()
+    repo_exceptions = []
+
+    def mirror_repos_in_thread(http_client, bar_position):
+        while True:
+            with mappings_lock:
+                try:
+                    source_base_url, target = next(mappings_it)
+                except StopIteration:
+                    break
 
-    with get_http_client() as http_client:
-        for source_base_url, target in mappings:
             logger.info('Starting %s to %s', source_base_url, target)
+            start = time.perf_counter()
             try:
-                mirror_repo(s3_client, http_client, source_base_url, target)
+                mirror_repo(http_client, source_base_url, target, bar_position)
             except Exception as e:
+                inc('repos_total', 1, repo=source_base_url, outcome='failed')
                 logger.exception('Failed mirroring %s to %s but carrying on', source_base_url, target)
-                if first_exception is None:
-                    first_exception = e
+                # When polling, a failed repo is tried again once it's next polled
+                if poll_interval is None:
+                    repo_exceptions.append(e)
+            else:
+                inc('repos_total', 1, repo=source_base_url, outcome='succeeded')
+            inc('repo_seconds_total', time.perf_counter() - start, repo=source_base_url)
             logger.info('Finished %s to %s', source_base_url, target)
+            on_mirrored(source_base_url, target)
+
+    # Processes are spawned rather than forked, since forking a process with threads is unsafe
+    object_processes = \
+        ProcessPoolExecutor(max_workers=num_object_processes, mp_context=multiprocessing.get_context('spawn')) if num_object_processes else \
+        nullcontext()
+    process_object = get_object_processor(object_processes) if num_object_processes else None
+
+    s3_requests_in_flight_limited = \
+        limit_requests_in_flight(s3_client, s3_requests_in_flight) if s3_requests_in_flight is not None else \
+        nullcontext()
+
+    with get_http_client() as http_client, object_processes, s3_requests_in_flight_limited:
+        mappings_it, on_mirrored, join_polling = \
+            (iter(mappings), lambda source_base_url, target: None, lambda: None) if poll_interval is None else \
+            start_polling(http_client, mappings)
+        repo_threads = [
+            Thread(target=mirror_repos_in_thread, args=(http_client, i * 2))
+            for i in range(0, max_concurrent_repos)
+        ]
+        for repo_thread in repo_threads:
+            repo_thread.start()
+        for repo_thread in repo_threads:
+            repo_thread.join()
+        join_polling()
+
+    # Only storages created here are closed, since others are owned by the caller
+    if get_storage is None:
+        for storage in storages.values():
+            if isinstance(storage, AsyncS3Storage):
+                storage.close()
+
+    logger.info('Base object cache hits: %s, misses: %s', *base_object_cache_stats())
 
-    if first_exception is not None:
-        raise first_exception
+    if repo_exceptions:
+        raise repo_exceptions[0]
 
     logger.info('End')
 
 
-@click.command()
-@click.option('--source', '-s', multiple=True, required=True)
-@click.option('--target', '-s', multiple=True, required=True)
-def main(source, target):
-    mirror_repos(zip(source, target))
+def verify_repos(targets,
+        get_s3_client=lambda: boto3.client('s3'),
+        get_storage=None,
+        sample=None,  # The fraction of blobs, and of packs, to fetch and check, None for all
+        max_requests_in_flight=64,  # Per target
+        base_object_cache_size=67108864,  # In bytes, for delta bases read from packs
+        storage_attempts=5,  # Of each storage request that's throttled
+    ):
+    # Checks that the objects reachable from the refs of each target are stored and not corrupt,
+    # and returns a (target, SHA or key, problem) tuple for each that isn't. Objects are found by
+    # walking commits and trees from the refs, and each is fetched, inflated and its SHA checked.
+    # In pack mode objects are read from the packs through their indexes, and the packs and
+    # indexes are also checked against their checksums
+
+    def get_objects_prefixes(storage, target_prefix):
+        # The target's own objects, and then those of its alternates, which are relative to them
+        try:
+            alternates = storage.get(f'{target_prefix}/objects/info/alternates').decode().splitlines()
+        except KeyError:
+            alternates = []
+        return [f'{target_prefix}/objects'] + [
+            posixpath.normpath(posixpath.join(f'{target_prefix}/objects', alternate))
+            for alternate in alternates
+            if alternate
+        ]
+
+    def get_referenced_objects(object_type, body):
+        # The (SHA, type) of each object that a commit, tag or tree refers to. Submodules are
+        # commits in other repos, and so are not followed
+        referenced = []
+        if object_type in (b'commit', b'tag'):
+            headers = [
+                header.partition(b' ')
+                for header in body.partition(b'\n\n')[0].split(b'\n')
+            ]
+            if object_type == b'commit':
+                referenced = [
+                    (bytes.fromhex(value.decode()), b'tree' if name == b'tree' else b'commit')
+                    for name, _, value in headers
+                    if name in (b'tree', b'parent')
+                ]
+            else:
+                values = {name: value for name, _, value in headers}
+                referenced = [(bytes.fromhex(values[b'object'].decode()), values[b'type'])]
+        elif object_type == b'tree':
+            offset = 0
+            while offset < len(body):
+                mode_end = body.index(b' ', offset)
+                name_end = body.index(b'\x00', mode_end)
+                mode = body[offset:mode_end]
+                if mode != b'160000':
+                    referenced.append((body[name_end + 1:name_end + 21], b'tree' if mode == b'40000' else b'blob'))
+                offset = name_end + 21
+        return referenced
+
+    def verify_loose_object(storage, objects_prefixes, sha, expected_type):
+        # Returns a problem or None, and the objects that this one refers to. The object is
+        # streamed, so large blobs are not loaded into memory. Errors fetching it are reported as
+        # a problem with the object rather than stopping the verification of the others
+        decompressor = zlib.decompressobj()
+        object_sha = sha1()
+        header = b''
+        object_type = None
+        body = []
+        body_length = 0
+        try:
+            for objects_prefix in objects_prefixes:
+                try:
+                    chunks = storage.get_stream(f'{objects_prefix}/{sha.hex()[:2]}/{sha.hex()[2:]}')
+                    break
+                except KeyError:
+                    pass
+            else:
+                return 'missing', []
+
+            for compressed_chunk in itertools.chain(chunks, (None,)):
+                chunk = decompressor.decompress(compressed_chunk) if compressed_chunk is not None else decompressor.flush()
+                object_sha.update(chunk)
+                if object_type is None:
+                    header += chunk
+                    if b'\x00' not in header:
+                        continue
+                    header, _, chunk = header.partition(b'\x00')
+                    object_type, _, length = header.partition(b' ')
+                body_length += len(chunk)
+                if object_type != b'blob':
+                    body.append(chunk)
+        except zlib.error:
+            return 'corrupt: not zlib compressed', []
+        except Exception as e:
+            return f'unreadable: {e!r}', []
+
+        if not decompressor.eof or object_type is None:
+            return 'corrupt: truncated', []
+        if object_sha.digest() != sha:
+            return f'corrupt: has SHA {object_sha.hexdigest()}', []
+        if not length.isdigit():
+            return 'corrupt: bad header', []
+        if int(length) != body_length:
+            return f'corrupt: has length {body_length} rather than {int(length)}', []
+        if expected_type is not None and object_type != expected_type:
+            return f'corrupt: is a {object_type.decode()} rather than a {expected_type.decode()}', []
+        try:
+            return None, get_referenced_objects(object_type, b''.join(body))
+        except (ValueError, KeyError):
+            return f'corrupt: {object_type.decode()} could not be parsed', []
+
+    def find_in_packs(packs, sha):
+        # The pack that has the object, and its offset in it, or (None, None)
+        for pack_info in packs:
+            _, index_shas, offsets, _ = pack_info
+            position = get_sorted_sha_position(index_shas, sha)
+            if position is not None:
+                return pack_info, offsets[position]
+        return None, None
+
+    def read_pack_object(storage, packs, base_cache_get, base_cache_put, pack, pack_offset):
+        # The type and body of the object at an offset in a pack. Its compressed bytes end where
+        # the next object in the pack starts, and if it's a delta its base is read in the same way
+        pack_key, _, _, sorted_offsets = pack
+        next_position = bisect_right(sorted_offsets, pack_offset)
+        entry = storage.get(pack_key, pack_offset, sorted_offsets[next_position] if next_position < len(sorted_offsets) else None)
+        _, read_bytes, read_byte, _, get_offset = get_reader((entry,))
+        object_type, object_length = get_object_type_and_length(read_byte)
+        if object_type == 6:
+            base_pack, base_pack_offset = pack, pack_offset - get_negative_offset(read_byte)
+        elif object_type == 7:
+            base_sha = read_bytes(20)
+            base_pack, base_pack_offset = find_in_packs(packs, base_sha)
+            if base_pack is None:
+                raise ValueError(f'delta base {base_sha.hex()} is not in any pack')
+        elif object_type not in types_names_for_hash:
+            raise ValueError(f'has unknown type {object_type}')
+
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(entry[get_offset():])
+        if not decompressor.eof:
+            raise ValueError('truncated')
+        if len(body) != object_length:
+            raise ValueError(f'has length {len(body)} rather than {object_length}')
+        if object_type not in (6, 7):
+            return types_names_for_hash[object_type], body
+
+        base_key = (base_pack[0], base_pack_offset)
+        base = base_cache_get(base_key)
+        if base is None:
+            base = read_pack_object(storage, packs, base_cache_get, base_cache_put, base_pack, base_pack_offset)
+            base_cache_put(base_key, base)
+        base_type, base_body = base
+        base_size, _, instructions = get_delta_instructions((body,))
+        if base_size != len(base_body):
+            raise ValueError(f'delta expects a base of length {base_size} rather than {len(base_body)}')
+        return base_type, b''.join(yield_delta_target(base_body, instructions))
+
+    def verify_pack_object(storage, packs, base_cache_get, base_cache_put, sha, expected_type):
+        # Returns a problem or None, and the objects that this one refers to
+        pack, pack_offset = find_in_packs(packs, sha)
+        if pack is None:
+            return 'missing', []
+        try:
+            object_type, body = read_pack_object(storage, packs, base_cache_get, base_cache_put, pack, pack_offset)
+        except zlib.error:
+            return 'corrupt: not zlib compressed', []
+        except ValueError as e:
+            return f'corrupt: {e}', []
+        except Exception as e:
+            return f'unreadable: {e!r}', []
+
+        object_sha = sha1(object_type + b' ' + str(len(body)).encode() + b'\x00')
+        object_sha.update(body)
+        if object_sha.digest() != sha:
+            return f'corrupt: has SHA {object_sha.hexdigest()}', []
+        if expected_type is not None and object_type != expected_type:
+            return f'corrupt: is a {object_type.decode()} rather than a {expected_type.decode()}', []
+        try:
+            return None, get_referenced_objects(object_type, body)
+        except (ValueError, KeyError):
+            return f'corrupt: {object_type.decode()} could not be parsed', []
+
+    def verify_objects(executor, root_shas, verify_object):
+        # Each object is only checked once, however many trees or commits refer to it
+        seen = ShaIndex()
+        in_flight = {}
+        problems = []
+        num_verified = 0
+
+        def submit(sha, object_type):
+            if sha in seen:
+                return
+            seen.add(sha)
+            if object_type == b'blob' and sample is not None and random.random() >= sample:
+                return
+            in_flight[executor.submit(verify_object, sha, object_type)] = sha
+
+        for sha in root_shas:
+            submit(sha, None)
+
+        while in_flight:
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                sha = in_flight.pop(future)
+                problem, referenced = future.result()
+                num_verified += 1
+                if problem is not None:
+                    problems.append((sha.hex(), problem))
+                for referenced_sha, referenced_type in referenced:
+                    submit(referenced_sha, referenced_type)
+
+        return num_verified, problems
+
+    def get_pack_index_entries(index):
+        # The sorted SHAs of a version 2 index, and the offset of each in the pack. Offsets with
+        # the top bit set are positions in the table of 8 byte offsets that follows
+        num_objects, = unpack('>I', index[1028:1032])
+        offsets_start = 1032 + num_objects * 24
+        large_offsets_start = offsets_start + num_objects * 4
+        offsets = [
+            offset if not offset & 0x80000000 else
+            unpack('>Q', index[large_offsets_start + (offset & 0x7fffffff) * 8:large_offsets_start + (offset & 0x7fffffff) * 8 + 8])[0]
+            for offset in unpack(f'>{num_objects}I', index[offsets_start:large_offsets_start])
+        ]
+        return index[1032:1032 + num_objects * 20], offsets
+
+    def verify_packs(storage, target_prefix, pack_names):
+        # The index of each pack is checked against its own checksum, and the pack, if it's in the
+        # sample, is streamed and checked against its trailer, which the index also records.
+        # Returns the packs with valid indexes, to read objects from
+        problems = []
+        packs = []
+        for pack_name in pack_names:
+            index_key = f'{target_prefix}/objects/pack/{pack_name}.idx'
+            pack_key = f'{target_prefix}/objects/pack/{pack_name}.pack'
+            try:
+                index = storage.get(index_key)
+            except KeyError:
+                problems.append((index_key, 'missing'))
+                continue
+            if sha1(index[:-20]).digest() != index[-20:]:
+                problems.append((index_key, 'corrupt: does not match its checksum'))
+                continue
+            index_shas, offsets = get_pack_index_entries(index)
+            packs.append((pack_key, index_shas, offsets, sorted(offsets)))
+
+            if sample is not None and random.random() >= sample:
+                continue
+            try:
+                chunks = storage.get_stream(pack_key)
+            except KeyError:
+                problems.append((pack_key, 'missing'))
+                continue
+            pack_sha = sha1()
+            tail = b''
+            for chunk in chunks:
+                tail += chunk
+                pack_sha.update(tail[:-20])
+                tail = tail[-20:]
+            if pack_sha.digest() != tail or tail != index[-40:-20]:
+                problems.append((pack_key, 'corrupt: does not match its trailer or index'))
+
+        return packs, problems
+
+    def verify_repo(target, executor):
+        parsed_target = urllib.parse.urlparse(target)
+        storage = \
+            get_storage(parsed_target.scheme, parsed_target.netloc) if get_storage is not None else \
+            get_default_storage(s3_client, parsed_target.scheme, parsed_target.netloc)
+        if storage is None:
+            raise ValueError(f'Unsupported target {target}')
+        # Throttled requests are retried, as when mirroring
+        storage = AdaptiveStorage(storage, (), storage_attempts)
+        target_prefix = parsed_target.path[1:]
+
+        try:
+            refs = storage.get(f'{target_prefix}/info/refs')
+        except KeyError:
+            return [(f'{target_prefix}/info/refs', 'missing')]
+        root_shas = list(dict.fromkeys(
+            bytes.fromhex(line.split(b'\t')[0].decode())
+            for line in refs.splitlines()
+        ))
+
+        try:
+            pack_names = [
+                line[2:].decode().removesuffix('.pack')
+                for line in storage.get(f'{target_prefix}/objects/info/packs').splitlines()
+                if line.startswith(b'P ')
+            ]
+        except KeyError:
+            pack_names = []
+
+        if pack_names:
+            packs, problems = verify_packs(storage, target_prefix, pack_names)
+            # The cached values are the type and body of each base
+            base_cache_get, base_cache_put, base_cache_stats = get_lru_cache(base_object_cache_size, get_size=lambda value: len(value[1]))
+            verify_object = partial(verify_pack_object, storage, packs, base_cache_get, base_cache_put)
+        else:
+            problems = []
+            base_cache_stats = None
+            verify_object = partial(verify_loose_object, storage, get_objects_prefixes(storage, target_prefix))
+        num_verified, object_problems = verify_objects(executor, root_shas, verify_object)
+        problems += object_problems
+        logger.info('Verified %s objects of %s, with %s problems', num_verified, target, len(problems))
+        if base_cache_stats is not None:
+            logger.info('Base object cache hits: %s, misses: %s', *base_cache_stats())
+        return problems
+
+    s3_client = get_s3_client()
+    problems = []
+    with ThreadPoolExecutor(max_workers=max_requests_in_flight) as executor:
+        for target in targets:
+            for name, problem in verify_repo(target, executor):
+                logger.error('%s %s: %s', target, name, problem)
+                problems.append((target, name, problem))
+    return problems
+
+
+def read_mappings(f):
+    # One mapping per line, the source then the target separated by whitespace. Blank lines and
+    # lines starting with # are ignored
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            source, target = line.split()
+            yield source, target
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+@click.option('--source', '-s', multiple=True)
+@click.option('--target', '-s', multiple=True)
+@click.option('--mappings-file', type=click.File('r'))
+@click.option('--incremental', is_flag=True, default=False)
+@click.option('--storage-format', type=click.Choice(['loose', 'pack']), default='loose')
+@click.option('--include-ref', multiple=True)
+@click.option('--exclude-ref', multiple=True)
+@click.option('--blob-size-limit', type=int)
+@click.option('--shared-objects-prefix')
+@click.option('--num-object-processes', type=int, default=0)
+@click.option('--max-concurrent-repos', type=int, default=1)
+@click.option('--max-s3-requests-in-flight', type=int)
+@click.option('--async-s3-requests-in-flight', type=int)
+@click.option('--adaptive-requests-in-flight', type=int)
+@click.option('--storage-attempts', type=int, default=5)
+@click.option('--max-http-connections', type=int)
+@click.option('--max-lfs-bytes-in-flight', type=int)
+@click.option('--max-object-bytes-in-flight', type=int, default=67108864)
+@click.option('--max-pack-bytes-buffered', type=int, default=16777216)
+@click.option('--poll-interval', type=float)
+@click.option('--max-polls-per-host-per-second', type=float, default=1.0)
+@click.option('--metrics-file', type=click.File('w'))
+@click.option('--metrics-format', type=click.Choice(['prometheus', 'json']), default='prometheus')
+@click.option('--trace-file', type=click.File('w'))
+def main(ctx, source, target, mappings_file, incremental, storage_format, include_ref, exclude_ref, blob_size_limit, shared_objects_prefix, num_object_processes, max_concurrent_repos, max_s3_requests_in_flight, async_s3_requests_in_flight, adaptive_requests_in_flight, storage_attempts, max_http_connections, max_lfs_bytes_in_flight, max_object_bytes_in_flight, max_pack_bytes_buffered, poll_interval, max_polls_per_host_per_second, metrics_file, metrics_format, trace_file):
+    # Without a subcommand, mirrors
+    if ctx.invoked_subcommand is not None:
+        return
+
+    if len(source) != len(target):
+        raise click.UsageError('Each --source must have a corresponding --target')
+    if not source and mappings_file is None:
+        raise click.UsageError('Either --source and --target or --mappings-file must be given')
+
+    metrics = Metrics() if metrics_file is not None else None
+    trace = Trace() if trace_file is not None else None
+
+    # When polling, SIGTERM and SIGINT stop polling, and the repos being mirrored are finished
+    stop_polling = Event()
+    if poll_interval is not None:
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda signal_number, frame: stop_polling.set())
+
+    try:
+        mirror_repos(
+            itertools.chain(zip(source, target), read_mappings(mappings_file) if mappings_file is not None else ()),
+            incremental=incremental,
+            storage_format=storage_format,
+            include_refs=include_ref or None,
+            exclude_refs=exclude_ref,
+            blob_size_limit=blob_size_limit,
+            shared_objects_prefix=shared_objects_prefix,
+            num_object_processes=num_object_processes,
+            max_concurrent_repos=max_concurrent_repos,
+            max_s3_requests_in_flight=max_s3_requests_in_flight,
+            async_s3_requests_in_flight=async_s3_requests_in_flight,
+            adaptive_requests_in_flight=adaptive_requests_in_flight,
+            storage_attempts=storage_attempts,
+            max_http_connections=max_http_connections,
+            max_lfs_bytes_in_flight=max_lfs_bytes_in_flight,
+            max_object_bytes_in_flight=max_object_bytes_in_flight,
+            max_pack_bytes_buffered=max_pack_bytes_buffered,
+            poll_interval=poll_interval,
+            max_polls_per_host_per_second=max_polls_per_host_per_second,
+            stop_polling=stop_polling,
+            metrics=metrics,
+            trace=trace,
+        )
+    finally:
+        if metrics is not None:
+            metrics_file.write(metrics.to_prometheus() if metrics_format == 'prometheus' else metrics.to_json())
+        if trace is not None:
+            trace_file.write(trace.to_chrome_json())
+
+
+@main.command()
+@click.option('--target', '-t', multiple=True)
+@click.option('--mappings-file', type=click.File('r'))
+@click.option('--sample', type=float)
+@click.option('--max-requests-in-flight', type=int, default=64)
+def verify(target, mappings_file, sample, max_requests_in_flight):
+    if not target and mappings_file is None:
+        raise click.UsageError('Either --target or --mappings-file must be given')
+
+    problems = verify_repos(
+        itertools.chain(target, (mapping_target for _, mapping_target in read_mappings(mappings_file)) if mappings_file is not None else ()),
+        sample=sample,
+        max_requests_in_flight=max_requests_in_flight,
+    )
+    for problem_target, name, problem in problems:
+        click.echo(f'{problem_target} {name} {problem}')
+    if problems:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':